@@ -0,0 +1,178 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import random
+from struct import pack
+from time import time
+from twisted.internet import reactor, defer
+
+from minerutil.ClientBase import ClientBase, AssignedWork
+
+class SyntheticClient(ClientBase):
+    """Stands in for a connection to a server, handing out random (but
+    well-formed) work whenever asked, and accepting every result.
+
+    The work is generated from a fixed seed, so that runs are reproducible.
+    """
+
+    # The network difficulty is set well above the share difficulty (1), so
+    # that results are handled as ordinary shares.
+    BITS = 0x1a0fffff
+    TARGET = ('\xff'*28) + ('\x00'*4)
+
+    def __init__(self, handler, seed=0):
+        self.handler = handler
+        self.random = random.Random(seed)
+        self.prevBlock = self._randomBytes(32)
+        self.results = 0
+
+    def _randomBytes(self, n):
+        return ''.join(chr(self.random.getrandbits(8)) for i in xrange(n))
+
+    def connect(self):
+        self.runCallback('connect')
+        self.requestWork()
+
+    def disconnect(self):
+        self._deactivateCallbacks()
+
+    def setMeta(self, var, value):
+        pass
+
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        pass
+
+    def requestWork(self, count=1):
+        self.deliverWork(count)
+
+    def _makeWork(self):
+        # The data is the block header with every 32-bit word byteswapped.
+        header = (pack('<I', 2) + self.prevBlock + self._randomBytes(32) +
+                  pack('<II', int(time()), self.BITS) + '\x00'*4)
+        aw = AssignedWork()
+        aw.data = ''.join(header[i:i+4][::-1] for i in xrange(0, 80, 4))
+        aw.target = self.TARGET
+        aw.mask = 32
+        aw.setMaxTimeIncrement(0)
+        aw.identifier = aw.data[4:36]
+        return aw
+
+    def sendResult(self, result, urgent=False):
+        self.results += 1
+        self.runCallback('sent', result)
+        return defer.succeed(True)
+
+class BenchmarkStats(object):
+    """Collects timings and counters from around the miner while a benchmark
+    is running. Miner.stats is set to one of these for the duration.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.startedAt = time()
+        self.samples = {}
+        self.counters = {}
+        self.pending = {}
+
+    def record(self, name, value):
+        """Add a sample (typically a duration, in seconds) to a statistic."""
+        self.samples.setdefault(name, []).append(value)
+
+    def found(self, result, foundAt):
+        """A kernel found result at foundAt; the time until it's actually
+        sent is recorded once the connection reports it through sent().
+        """
+        self.pending[result] = foundAt
+
+    def sent(self, result):
+        foundAt = self.pending.pop(result, None)
+        if foundAt is not None:
+            self.record('submit', time() - foundAt)
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def summarize(self, name):
+        """Return (count, mean, median, 95th percentile, max) of a statistic,
+        or None if there are no samples.
+        """
+        samples = sorted(self.samples.get(name, []))
+        if not samples:
+            return None
+        n = len(samples)
+        return (n, sum(samples)/n, samples[n//2],
+                samples[min(n-1, int(n*0.95))], samples[-1])
+
+class Benchmark(object):
+    """Runs the miner against a SyntheticClient for a fixed time and reports
+    how the whole pipeline performed. The first WARMUP seconds are discarded,
+    so the results reflect the steady state.
+    """
+
+    WARMUP = 10
+
+    # (statistic, description) for each timing in the report.
+    TIMINGS = [
+        ('dispatch', 'NonceRange dispatch latency'),
+        ('stall', 'Mining thread stalls waiting for a range'),
+        ('preprocess', 'Preprocessing time per range'),
+        ('submit', 'Nonce found until share sent'),
+    ]
+
+    def __init__(self, miner, duration):
+        self.miner = miner
+        self.duration = duration
+        self.stats = BenchmarkStats()
+
+    def start(self):
+        self.miner.stats = self.stats
+        self.miner.logger.reportType('Benchmark')
+        self.miner.logger.log('Benchmarking for %d seconds (plus %d seconds '
+                              'of warmup)...' % (self.duration, self.WARMUP))
+        reactor.callLater(self.WARMUP, self.stats.reset)
+        reactor.callLater(self.WARMUP + self.duration, self.finish)
+
+    def finish(self):
+        elapsed = time() - self.stats.startedAt
+        hashes = self.stats.counters.get('hashes', 0)
+
+        log = lambda msg: self.miner.logger.log(msg, False)
+        log('Benchmark results over %.1f seconds:' % elapsed)
+        log('  Hashrate: %.2f Mhash/sec (%d nonces)' %
+            (hashes / elapsed / 1e6, hashes))
+        for name, description in self.TIMINGS:
+            summary = self.stats.summarize(name)
+            if summary is None:
+                log('  %s: no samples' % description)
+            else:
+                log('  %s: %d samples, mean %.3f ms, median %.3f ms, '
+                    '95%% %.3f ms, max %.3f ms' % ((description, summary[0]) +
+                    tuple(x * 1000 for x in summary[1:])))
+        counters = self.stats.counters
+        log('  Nonces searched: %d (%d after going stale), abandoned as '
+            'stale: %d, dispatched again: %d' % (counters.get('searched', 0),
+            counters.get('stale', 0), counters.get('abandoned', 0),
+            counters.get('redispatched', 0)))
+        log('  Results submitted: %d' % counters.get('results', 0))
+
+        reactor.stop()
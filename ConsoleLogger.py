@@ -69,7 +69,7 @@ class ConsoleLogger(object):
     def reportBlock(self, block):
         self.log('Currently on block: ' + str(block))
 
-    def reportFound(self, hash, accepted):
+    def reportFound(self, hash, accepted, block=False):
         if accepted:
             self.accepted += 1
         else:
@@ -77,11 +77,12 @@ class ConsoleLogger(object):
 
         hexHash = hash[::-1]
         hexHash = hexHash[:8].encode('hex')
+        kind = 'Block' if block else 'Result'
         if self.verbose:
-            self.log('Result %s... %s' % (hexHash,
+            self.log('%s %s... %s' % (kind, hexHash,
                 'accepted' if accepted else 'rejected'))
         else:
-            self.log('Result: %s %s' % (hexHash[8:],
+            self.log('%s: %s %s' % (kind, hexHash[8:],
                 'accepted' if accepted else 'rejected'))
 
     def reportMsg(self, message):
@@ -110,6 +111,11 @@ class ConsoleLogger(object):
                 "[" + formatNumber(rate) + "hash/sec] "
                 "[" + str(self.accepted) + " Accepted] "
                 "[" + str(self.invalid) + " Rejected]" + type)
+            #show each core's rate as well when there is more than one
+            if self.verbose and len(self.miner.cores) > 1:
+                rates = [formatNumber(core.getRate() if not self.miner.idle
+                         else 0) for core in self.miner.cores]
+                status += " [" + ", ".join(rates) + "]"
             self.say(status)
             self.lastUpdate = time()
 
@@ -0,0 +1,190 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import json
+from time import time
+from hashlib import md5, sha1
+
+from minerutil.FileUtil import replaceFile
+
+def defaultCacheDir():
+    """The per-user directory compiled kernels are kept in by default."""
+    if os.name == 'nt' and os.environ.get('APPDATA'):
+        return os.path.join(os.environ['APPDATA'], 'Phoenix', 'cache')
+    return os.path.join(os.path.expanduser('~'), '.phoenix', 'cache')
+
+class KernelCache(object):
+    """A directory of compiled kernel binaries, which may be shared by any
+    number of Phoenix processes on the same host.
+
+    Every binary <key>.elf has an index entry <key>.json next to it, recording
+    the platform, device, defines, size and checksum of the binary, along with
+    when it was last used. Keeping one index entry per binary (rather than a
+    single index file) means that processes never have to lock anything: all
+    files are written to a temporary name and renamed into place, so a reader
+    sees either the complete old file or the complete new one. A binary that
+    doesn't match its index entry is simply treated as missing.
+
+    Once the binaries take up more than maxSize bytes, the least recently used
+    ones are removed.
+    """
+
+    BINARY_SUFFIX = '.elf'
+    INDEX_SUFFIX = '.json'
+
+    def __init__(self, directory=None, maxSize=64*1024*1024, debug=None):
+        self.directory = directory or defaultCacheDir()
+        self.maxSize = maxSize
+        self.debug = debug or (lambda msg: None)
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                self.debug('Cannot create kernel cache directory %s, '
+                           'compiled kernels will not be cached'
+                           % self.directory)
+                self.directory = None
+
+    @staticmethod
+    def makeKey(*parts):
+        """Derive a cache key from the compilation-specific pieces of
+        information (platform, device, defines, source...) given.
+        """
+        m = md5()
+        for part in parts:
+            m.update(part)
+            m.update('\x00')
+        return m.hexdigest()
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def _readIndex(self, key):
+        try:
+            with open(self._path(key, self.INDEX_SUFFIX), 'rb') as f:
+                return json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def index(self):
+        """Return the index entries of every binary in the cache, keyed on
+        their cache keys.
+        """
+        entries = {}
+        if self.directory is None:
+            return entries
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.endswith(self.INDEX_SUFFIX):
+                key = name[:-len(self.INDEX_SUFFIX)]
+                entry = self._readIndex(key)
+                if entry is not None:
+                    entries[key] = entry
+        return entries
+
+    def load(self, key):
+        """Return the cached binary for key, or None if there isn't a (valid)
+        one.
+        """
+        if self.directory is None:
+            return None
+
+        entry = self._readIndex(key)
+        if entry is None:
+            return None
+
+        try:
+            with open(self._path(key, self.BINARY_SUFFIX), 'rb') as f:
+                binary = f.read()
+        except (IOError, OSError):
+            return None
+
+        if len(binary) != entry.get('size') or \
+            sha1(binary).hexdigest() != entry.get('checksum'):
+            self.debug('Cached kernel %s is corrupt, discarding it' % key)
+            self.remove(key)
+            return None
+
+        # Remember that this entry was used, for eviction purposes.
+        entry['lastUsed'] = time()
+        try:
+            replaceFile(self._path(key, self.INDEX_SUFFIX), json.dumps(entry))
+        except (IOError, OSError):
+            pass
+
+        return binary
+
+    def store(self, key, binary, **info):
+        """Add a binary to the cache. Any keyword arguments (platform, device,
+        defines...) are recorded in its index entry.
+        """
+        if self.directory is None:
+            return
+
+        entry = dict(info)
+        entry['size'] = len(binary)
+        entry['checksum'] = sha1(binary).hexdigest()
+        entry['lastUsed'] = time()
+
+        # The binary goes first, so its index entry never refers to a binary
+        # that isn't there yet.
+        try:
+            replaceFile(self._path(key, self.BINARY_SUFFIX), binary)
+            replaceFile(self._path(key, self.INDEX_SUFFIX), json.dumps(entry))
+        except (IOError, OSError):
+            self.debug('Failed to write kernel %s to the cache' % key)
+            return
+
+        self.evict(keep=key)
+
+    def remove(self, key):
+        """Remove a binary and its index entry, if present."""
+        if self.directory is None:
+            return
+        for suffix in (self.INDEX_SUFFIX, self.BINARY_SUFFIX):
+            try:
+                os.remove(self._path(key, suffix))
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """Remove least recently used binaries until the cache fits in
+        maxSize bytes. The binary for key keep is never removed.
+        """
+        entries = self.index()
+        total = sum(entry.get('size', 0) for entry in entries.values())
+        if total <= self.maxSize:
+            return
+
+        byAge = sorted(entries.items(), key=lambda x: x[1].get('lastUsed', 0))
+        for key, entry in byAge:
+            if total <= self.maxSize:
+                break
+            if key == keep:
+                continue
+            self.debug('Evicting kernel %s from the cache' % key)
+            self.remove(key)
+            total -= entry.get('size', 0)
@@ -20,9 +20,15 @@
 # THE SOFTWARE.
 
 import os
+import threading
+from time import time
 from struct import pack, unpack
 from hashlib import sha256
 from twisted.internet import defer, reactor
+from twisted.python import log
+
+from WorkQueue import HASH_INVALID, HASH_BLOCK, targetToInt
+from KernelCache import KernelCache
 
 # I'm using this as a sentinel value to indicate that an option has no default;
 # it must be specified.
@@ -52,6 +58,45 @@ class KernelOption(object):
     def __set__(self, instance, value):
         self.localValues[instance] = value
 
+class ThreadChannel(object):
+    """Carries calls from mining threads over to the reactor thread, in
+    batches: however many calls are posted before the reactor gets around to
+    them, they cost a single reactor.callFromThread (and wake-up).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.scheduled = False
+
+    def post(self, function, *args):
+        """Have the reactor call function(*args), in order with the other
+        calls posted.
+        """
+        with self.lock:
+            self.calls.append((function, args))
+            if self.scheduled:
+                return
+            self.scheduled = True
+        reactor.callFromThread(self._run)
+
+    def postOnce(self, function, *args):
+        """Like post, unless the very same call is already waiting."""
+        with self.lock:
+            if (function, args) in self.calls:
+                return
+        self.post(function, *args)
+
+    def _run(self):
+        with self.lock:
+            calls, self.calls = self.calls, []
+            self.scheduled = False
+        for function, args in calls:
+            try:
+                function(*args)
+            except:
+                log.err()
+
 class CoreInterface(object):
     """An internal class provided for kernels to use when reporting info for
     one core.
@@ -65,15 +110,15 @@ class CoreInterface(object):
         self.kernelInterface.miner._addCore(self)
 
     def updateRate(self, rate):
-        """Called by a kernel core to report its current rate."""
+        """Called by a kernel core to report its current rate. The Miner
+        gathers up the rates of all cores on a timer.
+        """
 
         numSamples = self.kernelInterface.miner.options.getAvgSamples()
 
         self.averageSamples.append(rate)
         self.averageSamples = self.averageSamples[-numSamples:]
 
-        self.kernelInterface.miner.updateAverage()
-
     def getRate(self):
         """Retrieve the average rate for this core."""
 
@@ -93,6 +138,8 @@ class KernelInterface(object):
     def __init__(self, miner):
         self.miner = miner
         self._core = None
+        self._cache = None
+        self.channel = ThreadChannel()
 
     def _getOption(self, name, type, default):
         """KernelOption uses this to read the actual value of the option."""
@@ -125,6 +172,16 @@ class KernelInterface(object):
         """Deprecated. Kernels are now responsible for requesting optimal size
         work"""
 
+    def getKernelCache(self):
+        """Return the KernelCache that kernels should keep their compiled
+        binaries in.
+        """
+        if self._cache is None:
+            self._cache = KernelCache(self.miner.options.getCacheDir(),
+                                      self.miner.options.getCacheSize(),
+                                      self.debug)
+        return self._cache
+
     def setMeta(self, var, value):
         """Set metadata for this kernel."""
 
@@ -140,6 +197,15 @@ class KernelInterface(object):
         else:
             return self.miner.queue.fetchRange(size)
 
+    def releaseRange(self, nr, searched=True):
+        """Give back a NonceRange from fetchRange once the kernel is done with
+        it, saying whether every nonce in it was searched (True or False), or
+        how many were, counting up from its base. What wasn't searched is
+        dispatched again, unless it has gone stale.
+        """
+
+        self.miner.queue.releaseRange(nr, searched)
+
     def addStaleCallback(self, callback):
         """Register a new function to be called, with no arguments, whenever
         a new block comes out that would render all previous work stale,
@@ -169,14 +235,19 @@ class KernelInterface(object):
         intended to be used in hardware sanity-checks.
         """
 
-        # This for loop compares the bytes of the target and hash in reverse
-        # order, because both are 256-bit little endian.
-        for t,h in zip(target[::-1], hash[::-1]):
-            if ord(t) > ord(h):
-                return True
-            elif ord(t) < ord(h):
-                return False
-        return True
+        # Both are 256-bit little endian.
+        return targetToInt(hash) <= targetToInt(target)
+
+    def _getPrefixHash(self, unit):
+        """Return a SHA-256 object that has already hashed the first 76 bytes
+        of the block header. This is computed once per WorkUnit, so checking
+        a nonce only costs hashing the nonce itself and the second SHA-256.
+        """
+        if unit.prefixHash is None:
+            staticDataUnpacked = unpack('<' + 'I'*19, unit.data[:76])
+            staticData = pack('>' + 'I'*19, *staticDataUnpacked)
+            unit.prefixHash = sha256(staticData)
+        return unit.prefixHash
 
     def calculateHash(self, nr, nonce):
         """Given a NonceRange and a nonce, calculate the SHA-256 hash of the
@@ -188,13 +259,42 @@ class KernelInterface(object):
         # nonce is invalid, it will be caught anyway...
         nonce &= 0xFFFFFFFF
 
-        staticDataUnpacked = unpack('<' + 'I'*19, nr.unit.data[:76])
-        staticData = pack('>' + 'I'*19, *staticDataUnpacked)
-        hashInput = pack('>76sI', staticData, nonce)
-        return sha256(sha256(hashInput).digest()).digest()
+        h = self._getPrefixHash(nr.unit).copy()
+        h.update(pack('>I', nonce))
+        return sha256(h.digest()).digest()
 
-    def foundNonce(self, nr, nonce):
-        """Called by kernels when they may have found a nonce."""
+    def _sendResult(self, nr, nonce, hash, result, foundAt):
+        """Send a verified nonce to the server. result is what classifyHash
+        made of it, and foundAt is when the kernel found it.
+        """
+        block = (result == HASH_BLOCK)
+        if block:
+            self.miner.logger.log('Found a block-level solution!')
+
+        formattedResult = nr.unit.data[:76] + pack('<I', nonce)
+        if self.miner.journal is not None:
+            d = self.miner.journal.submit(formattedResult, block)
+        else:
+            d = self.miner.connection.sendResult(formattedResult, block)
+            # Without a journal, a result that can't be delivered is lost.
+            d.addErrback(lambda failure: False)
+
+        stats = self.miner.stats
+        if stats is not None:
+            stats.found(formattedResult, foundAt)
+            stats.count('results')
+
+        def callback(accepted):
+            self.miner.logger.reportFound(hash, accepted, block)
+        d.addCallback(callback)
+
+    def foundNonce(self, nr, nonce, foundAt=None):
+        """Called by kernels when they may have found a nonce. foundAt is
+        when the kernel found it, if it kept track.
+        """
+
+        if foundAt is None:
+            foundAt = time()
 
         # Sometimes kernels send weird nonces down the pipe. We can assume they
         # accidentally set bits outside of the 32-bit space. If the resulting
@@ -208,19 +308,48 @@ class KernelInterface(object):
 
         # Check if the hash meets the full difficulty before sending.
         hash = self.calculateHash(nr, nonce)
+        result = nr.unit.classifyHash(hash)
 
-        if self.checkTarget(hash, nr.unit.target):
-            formattedResult = pack('<76sI', nr.unit.data[:76], nonce)
-            d = self.miner.connection.sendResult(formattedResult)
-            def callback(accepted):
-                self.miner.logger.reportFound(hash, accepted)
-            d.addCallback(callback)
+        if result != HASH_INVALID:
+            self._sendResult(nr, nonce, hash, result, foundAt)
             return True
         else:
             self.miner.logger.reportDebug("Result didn't meet full "
                    "difficulty, not sending")
             return False
 
+    def verifyNonces(self, nr, nonces, foundAt=None):
+        """Called by kernels with the possible nonces they found in one
+        NonceRange. Duplicates are only checked once. Nonces that don't even
+        meet difficulty 1 are reported as a likely hardware problem. foundAt
+        is when the kernel found them, as taken in its mining thread.
+
+        Returns the number of nonces that were sent to the server.
+        """
+
+        if foundAt is None:
+            foundAt = time()
+
+        # A stale NonceRange can't produce anything worth sending.
+        if self.miner.queue.isRangeStale(nr):
+            return 0
+
+        sent = 0
+        invalid = 0
+        for nonce in set(int(n) & 0xFFFFFFFF for n in nonces):
+            hash = self.calculateHash(nr, nonce)
+            result = nr.unit.classifyHash(hash)
+            if result != HASH_INVALID:
+                self._sendResult(nr, nonce, hash, result, foundAt)
+                sent += 1
+            elif not hash.endswith('\x00\x00\x00\x00'):
+                invalid += 1
+
+        if invalid:
+            self.error('%d nonce(s) from the kernel failed verification. '
+                'Hardware problem?' % invalid)
+        return sent
+
     def debug(self, msg):
         """Log information as debug so that it can be viewed only when -v is
         enabled.
@@ -21,9 +21,11 @@
 
 import platform
 from time import time
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 from minerutil.MMPProtocol import MMPClient
+from minerutil.StratumProtocol import StratumClient
 from KernelInterface import KernelInterface
+from PoolManager import PoolManager
 
 #The main managing class for the miner itself.
 class Miner(object):
@@ -33,29 +35,31 @@ class Miner(object):
     REVISION = reduce(lambda x,y: x*100+y, VER)
     VERSION = 'v%s' % '.'.join(str(x) for x in VER)
 
+    # How often the cores' rates are summed up and reported
+    RATE_INTERVAL = 1.0
+
     def __init__(self):
         self.logger = None
         self.options = None
         self.connection = None
         self.kernel = None
         self.queue = None
+        self.journal = None
         self.idle = True
         self.cores = []
-        self.backup = False
-        self.failures = 0
         self.lastMetaRate = 0.0
         self.lastRateUpdate = time()
+        self.rateCall = None
+        self.stats = None # Set while benchmarking, see Benchmark.
 
     # Connection callbacks...
     def onFailure(self):
         self.logger.reportConnectionFailed()
 
-        #handle failover if url2 has been specified
-        if self.options.url2 is not None:
-            self.failoverCheck()
-
     def onConnect(self):
         self.logger.reportConnected(True)
+        if self.journal is not None:
+            self.journal.retryNow()
     def onDisconnect(self):
         self.logger.reportConnected(False)
     def onBlock(self, block):
@@ -69,56 +73,14 @@ class Miner(object):
         self.logger.reportType('RPC' + (' (+LP)' if lp else ''))
     def onPush(self, ignored):
         self.logger.log('LP: New work pushed')
+    def onSent(self, result):
+        if self.stats is not None:
+            self.stats.sent(result)
     def onLog(self, message):
         self.logger.log(message)
     def onDebug(self, message):
         self.logger.reportDebug(message)
 
-    def failoverCheck(self):
-        if self.backup:
-            if (self.failures >= 1):
-                #disconnect and set connection to none
-                self.connection.disconnect()
-                self.connection = None
-
-                #log
-                self.logger.log("Backup server failed,")
-                self.logger.log("attempting to return to primary server.")
-
-                #reset failure count and return to primary server
-                self.failures = 0
-                self.backup = False
-                self.connection = self.options.makeConnection(self)
-                self.connection.connect()
-            else:
-                self.failures += 1
-        else:
-            #The main pool must fail 3 times before moving to the backup pool
-            if (self.failures >= 2):
-                #disconnect and set connection to none
-                self.connection.disconnect()
-                self.connection = None
-
-                #log
-                self.logger.log("Primary server failed too many times,")
-                self.logger.log("attempting to connect to backup server.")
-
-                #reset failure count and connect to backup server
-                self.failures = 0
-                self.backup = True
-                self.connection = self.options.makeConnection(self, True)
-                self.connection.connect()
-            else:
-                self.failures += 1
-
-                #since the main pool may fail from time to time, decrement the
-                #failure count after 5 minutes so we don't end up moving to the
-                #back pool when it isn't nessesary
-                def decrementFailures():
-                    if self.failures > 1 and (not self.backup):
-                        self.failures -= 1
-                reactor.callLater(300, decrementFailures)
-
     def start(self, options):
         #Configures the Miner via the options specified and begins mining.
 
@@ -127,6 +89,7 @@ class Miner(object):
         self.connection = self.options.makeConnection(self)
         self.kernel = self.options.makeKernel(KernelInterface(self))
         self.queue = self.options.makeQueue(self)
+        self.journal = self.options.makeJournal(self)
 
         #log a message to let the user know that phoenix is starting
         self.logger.log("Phoenix %s starting..." % self.VERSION)
@@ -134,20 +97,32 @@ class Miner(object):
         #this will need to be changed to add new protocols
         if isinstance(self.connection, MMPClient):
             self.logger.reportType('MMP')
+        elif isinstance(self.connection, StratumClient):
+            self.logger.reportType('Stratum')
+        elif isinstance(self.connection, PoolManager):
+            self.logger.reportType('%d pools' % len(self.connection.pools))
         else:
             self.logger.reportType('RPC')
 
         self.applyMeta()
 
         # Go!
+        if self.journal is not None:
+            self.journal.open()
         self.connection.connect()
         self.kernel.start()
+        self.rateCall = task.LoopingCall(self.updateAverage)
+        self.rateCall.start(self.RATE_INTERVAL, False)
         reactor.addSystemEventTrigger('before', 'shutdown', self.shutdown)
 
     def shutdown(self):
         """Disconnect from the server and kill the kernel."""
+        if self.rateCall is not None and self.rateCall.running:
+            self.rateCall.stop()
         self.kernel.stop()
         self.connection.disconnect()
+        if self.journal is not None:
+            self.journal.close()
 
     def applyMeta(self):
         #Applies any static metafields to the connection, such as version,
@@ -169,6 +144,10 @@ class Miner(object):
     #used by WorkQueue to report when the miner is idle
     def reportIdle(self, idle):
 
+        #let the PoolManager hold idle time against the pools responsible
+        if isinstance(self.connection, PoolManager):
+            self.connection.reportIdle(idle)
+
         #if idle status has changed force an update
         if self.idle != idle:
             if idle:
@@ -189,7 +168,8 @@ class Miner(object):
             reactor.callLater(15, self.idleFixer)
 
     def updateAverage(self):
-        #Query all mining cores for their Khash/sec rate and sum.
+        #Query all mining cores for their Khash/sec rate and sum, every
+        #RATE_INTERVAL seconds.
 
         total = 0
         if not self.idle:
@@ -0,0 +1,396 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import urlparse
+from time import time
+from collections import OrderedDict, deque
+from twisted.internet import task
+
+import minerutil
+
+class PoolHealth(object):
+    """Running measures of how well a pool is serving us. Each is a moving
+    average of its samples, which also decays towards zero (i.e. healthy) as
+    time passes without any, so a pool that was in trouble recovers once it
+    stops misbehaving.
+    """
+
+    # How much each new sample counts, and how long a measure takes to halve
+    # on its own.
+    ALPHA = 0.25
+    HALF_LIFE = 120.0
+
+    # The value of each measure at which a pool is as unhealthy as it gets:
+    # seconds to answer a request for work, fraction of results rejected,
+    # seconds behind the first pool to move to a new block, and seconds the
+    # miner sat idle while mining for the pool.
+    LIMITS = OrderedDict([('latency', 10.0), ('rejects', 0.2), ('lag', 30.0),
+                          ('idle', 30.0)])
+
+    def __init__(self):
+        self.values = dict((name, 0.0) for name in self.LIMITS)
+        self.updated = dict((name, time()) for name in self.LIMITS)
+
+    def get(self, name, now=None):
+        now = now or time()
+        elapsed = max(0, now - self.updated[name])
+        return self.values[name] * 0.5 ** (elapsed / self.HALF_LIFE)
+
+    def add(self, name, sample):
+        now = time()
+        value = self.get(name, now)
+        self.values[name] = value + self.ALPHA * (sample - value)
+        self.updated[name] = now
+
+    def current(self, pending={}):
+        """The value of every measure. pending gives lower bounds for those
+        still being sampled, such as a request that hasn't been answered yet.
+        """
+        now = time()
+        return dict((name, max(self.get(name, now), pending.get(name, 0)))
+                    for name in self.LIMITS)
+
+    def score(self, pending={}):
+        """The pool's health, from 1 (perfect) down to 0."""
+        values = self.current(pending)
+        score = 1.0
+        for name, limit in self.LIMITS.items():
+            score *= 1 - min(1.0, values[name] / limit)
+        return score
+
+    def describe(self, pending={}):
+        values = self.current(pending)
+        return ('latency %.1fs, %d%% rejected, %.1fs behind on blocks, '
+                '%.1fs idle' % (values['latency'], 100 * values['rejects'],
+                values['lag'], values['idle']))
+
+class Pool(object):
+    """One of the PoolManager's pools. It is the handler for its connection's
+    callbacks, passing them on to the manager with the pool attached.
+    """
+
+    # The longest a request for work is considered to be on its way.
+    MAX_WAIT = 60
+
+    def __init__(self, manager, url, weight):
+        self.manager = manager
+        self.url = url
+        self.weight = weight
+        parsed = urlparse.urlparse(url)
+        self.name = parsed.hostname or url
+        if parsed.port:
+            self.name += ':%d' % parsed.port
+        self.connection = minerutil.openURL(url, self)
+        self.connected = False
+        self.block = None
+        self.current = 0 # For the weighted round-robin, see PoolManager.
+
+        self.health = PoolHealth()
+        self.healthy = True
+        self.requests = deque() # When each unit on its way was asked for.
+        self.prevBlock = None # The previous block hash of its latest work.
+
+    def onConnect(self):
+        self.connected = True
+        self.manager._poolConnected(self)
+    def onDisconnect(self):
+        self.connected = False
+        self.requests.clear()
+        self.prevBlock = None
+        self.manager._poolDisconnected(self)
+    def onFailure(self):
+        self.manager.logger.log('Failed to connect to %s, retrying...' %
+                                self.name)
+    def onBlock(self, block):
+        if self.block != block:
+            self.block = block
+            self.manager.logger.log('%s is on block: %s' % (self.name, block))
+    def onMsg(self, msg):
+        self.manager.logger.reportMsg('%s: %s' % (self.name, msg))
+    def onWork(self, work):
+        self.manager._workReceived(self, work)
+    def onLongpoll(self, lp):
+        self.manager.logger.reportDebug('%s long polling %s' % (self.name,
+                                        'started' if lp else 'stopped'))
+    def onPush(self, ignored):
+        self.manager.logger.log('LP: New work pushed by %s' % self.name)
+    def onSent(self, result):
+        self.manager.miner.onSent(result)
+    def onLog(self, message):
+        self.manager.logger.log(message)
+    def onDebug(self, message):
+        self.manager.logger.reportDebug('%s: %s' % (self.name, message))
+
+    def expireRequests(self, now):
+        # Requests that never got an answer (e.g. failed) stop counting.
+        while self.requests and now - self.requests[0] > self.MAX_WAIT:
+            self.requests.popleft()
+
+    def pending(self):
+        """Lower bounds on the health measures that are still being sampled:
+        how long an outstanding request for work has taken so far, and how
+        long the miner has been idle waiting on this pool.
+        """
+        pending = {}
+        now = time()
+        if self.requests:
+            pending['latency'] = now - self.requests[0]
+        if self.manager.idleSince is not None and \
+            self in self.manager.idlePools:
+            pending['idle'] = now - self.manager.idleSince
+        return pending
+
+    def score(self):
+        """The pool's current health score; see PoolHealth."""
+        if not self.connected:
+            return 0.0
+        return self.health.score(self.pending())
+
+class PoolManager(object):
+    """Mines for several pools at once. It holds a connection to each, and
+    stands in for a single connection as far as the rest of the miner is
+    concerned.
+
+    Work is requested from the connected pools in proportion to their
+    weights, which splits the hashrate the same way. Pools with a weight of 0
+    are backups: they stay connected (so that switching to one is instant),
+    but are only asked for work while no other pool is usable. Each result
+    goes back to the pool that issued its work.
+
+    Every pool is scored continuously on its getwork latency, reject rate,
+    how quickly it moves to new blocks, and how long it leaves the miner
+    idle. Pools whose score drops below UNHEALTHY are passed over in favour of
+    healthy ones until it climbs back above HEALTHY.
+    """
+
+    # How many work units to remember the pool of, for routing results.
+    MAX_UNITS = 4096
+
+    # How many new blocks to remember when they were first seen.
+    MAX_BLOCKS = 64
+
+    # Health scores to fail over at, and to return at, and how often (in
+    # seconds) they're checked.
+    UNHEALTHY = 0.5
+    HEALTHY = 0.8
+    CHECK_INTERVAL = 5
+
+    def __init__(self, miner, pools):
+        self.miner = miner
+        self.logger = miner.logger
+        self.pools = [Pool(self, url, weight) for url, weight in pools]
+        self.units = OrderedDict()
+        self.blocks = OrderedDict()
+        self.active = []
+        self.idleSince = None
+        self.idlePools = []
+        self.checkCall = task.LoopingCall(self._checkHealth)
+
+    def connect(self):
+        for pool in self.pools:
+            pool.connection.connect()
+        self.checkCall.start(self.CHECK_INTERVAL, False)
+
+    def disconnect(self):
+        if self.checkCall.running:
+            self.checkCall.stop()
+        for pool in self.pools:
+            pool.connection.disconnect()
+
+    def setMeta(self, var, value):
+        for pool in self.pools:
+            pool.connection.setMeta(var, value)
+
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        for pool in self.pools:
+            pool.connection.setVersion(shortname, longname, version, author)
+
+    def _weights(self):
+        """The pools to ask for work, with their weights: the healthy pools
+        if there are any, otherwise the rest of the connected ones. Backups are
+        only used when no weighted pool is usable, and share equally.
+        """
+        connected = [pool for pool in self.pools if pool.connected]
+        healthy = [pool for pool in connected if pool.healthy]
+        for pools in (healthy, connected):
+            weights = [(pool, pool.weight) for pool in pools
+                       if pool.weight > 0]
+            if not weights:
+                weights = [(pool, 1) for pool in pools]
+            if weights:
+                return weights
+        return []
+
+    def _choose(self, weights, chosen=None):
+        # Smooth weighted round-robin: every pool earns its weight, and the
+        # one with the most credit is picked and pays for it with the total.
+        # Over any stretch of picks, each pool gets its share, interleaved.
+        # Passing chosen charges that pool instead, as if it had been picked.
+        for pool, weight in weights:
+            pool.current += weight
+        if chosen is None:
+            chosen = max(weights, key=lambda x: x[0].current)[0]
+        chosen.current -= sum(weight for pool, weight in weights)
+        return chosen
+
+    def _owed(self, pool, weights):
+        """Whether pool is the one the round-robin would pick next."""
+        return max(weights, key=lambda x: x[0].current + x[1])[0] is pool
+
+    def requestWork(self, count=1):
+        """Make sure count units of work are on their way from the active
+        pools, split according to their weights: only the shortfall is newly
+        asked for. If none is connected, every pool is asked, which also gets
+        the ones that only connect on demand going again.
+        """
+        weights = self._weights()
+        if not weights:
+            for pool in self.pools:
+                pool.connection.requestWork()
+            return
+
+        now = time()
+        for pool, weight in weights:
+            pool.expireRequests(now)
+        needed = count - sum(len(pool.requests) for pool, weight in weights)
+        for i in range(needed):
+            self._choose(weights).requests.append(now)
+        for pool, weight in weights:
+            if pool.requests:
+                pool.connection.requestWork(len(pool.requests))
+
+    def sendResult(self, result, urgent=False):
+        """Send a result to the pool its work came from. A result from work
+        that's been forgotten (e.g. from the share journal after a restart)
+        goes to the first active pool.
+        """
+        pool = self.units.get(result[4:68])
+        if pool is None:
+            weights = self._weights()
+            pool = weights[0][0] if weights else self.pools[0]
+        d = pool.connection.sendResult(result, urgent)
+
+        def callback(accepted):
+            pool.health.add('rejects', 0.0 if accepted else 1.0)
+            return accepted
+        d.addCallback(callback)
+        return d
+
+    def reportIdle(self, idle):
+        """Called by the Miner when the work queue runs dry, or fills again.
+        The idle time counts against the pools that were meant to be
+        supplying work.
+        """
+        if idle and self.idleSince is None:
+            self.idleSince = time()
+            self.idlePools = [pool for pool, weight in self._weights()]
+        elif not idle and self.idleSince is not None:
+            duration = time() - self.idleSince
+            for pool in self.idlePools:
+                pool.health.add('idle', duration)
+            self.idleSince = None
+            self.idlePools = []
+
+    def _workReceived(self, pool, work):
+        now = time()
+        pulled = bool(pool.requests)
+        if pulled:
+            pool.health.add('latency', now - pool.requests.popleft())
+
+        # How long after the first pool this one moved to a new block.
+        prevBlock = work.data[4:36]
+        newBlock = prevBlock != pool.prevBlock
+        if newBlock:
+            if pool.prevBlock is not None:
+                seen = self.blocks.setdefault(prevBlock, now)
+                pool.health.add('lag', now - seen)
+            else:
+                self.blocks.setdefault(prevBlock, now)
+            while len(self.blocks) > self.MAX_BLOCKS:
+                self.blocks.popitem(False)
+            pool.prevBlock = prevBlock
+
+        # Work from a pool that isn't being mined for (such as a backup's
+        # long poll) only counts towards its health. Anything still queued or
+        # being mined from it is stale once it has a new block, though.
+        weights = self._weights()
+        if pool not in [p for p, weight in weights]:
+            queue = self.miner.queue
+            if queue.newBlock(pool, work.identifier):
+                queue.notifyStale()
+            return
+
+        # Pushed work (long polls, Stratum jobs and the like) takes up the
+        # pool's share just as work asked for does, so the hashrate still
+        # follows the weights. Beyond its share, it's only kept when it's for
+        # a new block, which the WorkQueue needs to hear about.
+        if not pulled:
+            if not newBlock and not self._owed(pool, weights):
+                return
+            self._choose(weights, pool)
+
+        # The previous block and merkle root identify the work, and survive
+        # ntime rolling.
+        work.pool = pool
+        self.units[work.data[4:68]] = pool
+        while len(self.units) > self.MAX_UNITS:
+            self.units.popitem(False)
+        self.miner.onWork(work)
+
+    def _poolConnected(self, pool):
+        self.logger.log('Connected to %s' % pool.name)
+        if self.miner.journal is not None:
+            self.miner.journal.retryNow()
+        self._updateActive()
+
+    def _poolDisconnected(self, pool):
+        self.logger.log('Disconnected from %s' % pool.name)
+        self._updateActive()
+
+    def _checkHealth(self):
+        for pool in self.pools:
+            if not pool.connected:
+                continue
+            score = pool.score()
+            if pool.healthy and score < self.UNHEALTHY:
+                pool.healthy = False
+                self.logger.log('%s is unhealthy (%s)' % (pool.name,
+                                pool.health.describe(pool.pending())))
+            elif not pool.healthy and score >= self.HEALTHY:
+                pool.healthy = True
+                self.logger.log('%s is healthy again' % pool.name)
+            self.logger.reportDebug('%s health %.2f (%s)' % (pool.name, score,
+                                    pool.health.describe(pool.pending())))
+        self._updateActive()
+
+    def _updateActive(self):
+        """Report which pools are being mined for, whenever that changes. A
+        switch while the miner is idle asks the new pools for work at once.
+        """
+        active = [pool for pool, weight in self._weights()]
+        if active == self.active:
+            return
+        self.active = active
+        if active:
+            self.logger.log('Mining for ' + ', '.join(pool.name
+                                                      for pool in active))
+        if active and self.miner.idle:
+            self.requestWork(self.miner.queue.queueSize)
@@ -0,0 +1,664 @@
+#!/usr/bin/python
+
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""A stand-in mining pool, for testing Phoenix's protocol clients without a
+real pool. It speaks getwork JSON-RPC (with long polling, X-Roll-NTime and
+X-Reject-Reason), MMP and Stratum, finds "blocks" on a timer, and can inject
+latency, errors and disconnects so that the clients can be measured under
+load.
+
+It also answers getblocktemplate and submitblock like a regtest node, so
+that solo mining can be tested. A valid block (which at regtest difficulty
+is almost any) advances the simulated chain.
+"""
+
+import os
+import json
+import random
+from time import time
+from struct import pack, unpack
+from optparse import OptionParser
+from twisted.internet import reactor, task
+from twisted.internet.protocol import ServerFactory
+from twisted.protocols.basic import LineReceiver
+from twisted.web import server, resource
+
+from minerutil.MMPProtocol import MMPProtocolBase, PROTOCOL_VERSION
+from minerutil.Midstate import calculateMidstates
+from minerutil.WorkBuilder import swap32, doubleSHA, merkleRoot, \
+                                  merkleBranch, buildHeader
+
+# What getwork appends to the 80 bytes of header data: SHA-256 padding.
+GETWORK_PADDING = swap32('\x80' + '\x00'*39 + '\x00\x00\x02\x80')
+
+def readVarint(data, offset):
+    """Read a Bitcoin variable-length integer, returning it and the offset
+    just after it.
+    """
+    n = ord(data[offset])
+    if n < 0xfd:
+        return n, offset + 1
+    size = {0xfd: 2, 0xfe: 4, 0xff: 8}[n]
+    return (int(data[offset+1:offset+1+size][::-1].encode('hex'), 16),
+            offset + 1 + size)
+
+def parseTransaction(data, offset):
+    """Find the end of the transaction at offset. Returns the offset just
+    after it, and the transaction without any witness data (the part that's
+    hashed for the txid).
+    """
+    start = offset
+    segwit = (data[offset+4:offset+6] == '\x00\x01')
+    offset += 6 if segwit else 4
+    body = offset
+
+    inputs, offset = readVarint(data, offset)
+    for i in range(inputs):
+        length, offset = readVarint(data, offset + 36)
+        offset += length + 4
+    outputs, offset = readVarint(data, offset)
+    for i in range(outputs):
+        length, offset = readVarint(data, offset + 8)
+        offset += length
+    bodyEnd = offset
+
+    if segwit:
+        for i in range(inputs):
+            items, offset = readVarint(data, offset)
+            for j in range(items):
+                length, offset = readVarint(data, offset)
+                offset += length
+
+    if offset + 4 > len(data):
+        raise ValueError('truncated transaction')
+    stripped = data[start:start+4] + data[body:bodyEnd] + \
+               data[offset:offset+4]
+    return offset + 4, stripped
+
+class Pool(object):
+    """The state shared by every protocol: the current block, the work handed
+    out for it, and statistics. Also decides when to misbehave.
+    """
+
+    BITS = 0x1a0fffff
+
+    # Block templates are at regtest difficulty.
+    TEMPLATE_BITS = 0x207fffff
+
+    def __init__(self, options):
+        self.options = options
+        if options.difficulty > 1:
+            target = int((0xFFFF << 208) / options.difficulty)
+            self.target = ('%064x' % target).decode('hex')[::-1]
+        else:
+            self.target = ('\xff'*28) + ('\x00'*4)
+        self.blockNumber = 0
+        self.prevBlock = None
+        self.issued = set()
+        self.listeners = []
+        self.stats = dict(getwork=0, longpoll=0, submitted=0, accepted=0,
+                          rejected=0, errors=0, disconnects=0, templates=0)
+        self.newBlock()
+
+    def start(self):
+        if self.options.blocktime > 0:
+            task.LoopingCall(self.newBlock).start(self.options.blocktime,
+                                                  False)
+        if self.options.statsinterval > 0:
+            task.LoopingCall(self.printStats).start(
+                self.options.statsinterval, False)
+
+    def newBlock(self):
+        """Advance to a new block, making all previous work stale."""
+        self.blockNumber += 1
+        self.prevBlock = os.urandom(32)
+        self.issued = set()
+        # Stand-ins for the transactions in a block template, and its witness
+        # commitment. They're never parsed, so they needn't be valid.
+        self.transactions = [os.urandom(random.randint(60, 250))
+                             for i in range(random.randint(0, 5))]
+        self.witnessCommitment = '\x6a\x24\xaa\x21\xa9\xed' + os.urandom(32)
+        print('Block %d' % self.blockNumber)
+        for listener in list(self.listeners):
+            listener(self.blockNumber)
+
+    def makeWork(self):
+        """Make new work, returned in the getwork data format (80 bytes)."""
+        merkleRoot = os.urandom(32)
+        self.issued.add(merkleRoot)
+        header = (pack('<I', 2) + self.prevBlock + merkleRoot +
+                  pack('<II', int(time()), self.BITS) + '\x00'*4)
+        return swap32(header)
+
+    def makeTemplate(self):
+        """Make a getblocktemplate result for the current block."""
+        self.stats['templates'] += 1
+        bits = self.TEMPLATE_BITS
+        target = (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+        transactions = [{'data': tx.encode('hex'),
+                         'txid': doubleSHA(tx)[::-1].encode('hex'),
+                         'hash': doubleSHA(tx)[::-1].encode('hex')}
+                        for tx in self.transactions]
+        return {
+            'version': 0x20000000,
+            'previousblockhash': self.prevBlock[::-1].encode('hex'),
+            'transactions': transactions,
+            'coinbasevalue': 5000000000,
+            'longpollid': str(self.blockNumber),
+            'target': '%064x' % target,
+            'mutable': ['time', 'transactions', 'prevblock'],
+            'curtime': int(time()),
+            'bits': '%08x' % bits,
+            'height': self.blockNumber,
+            'default_witness_commitment': self.witnessCommitment.encode('hex'),
+        }
+
+    def checkBlock(self, block):
+        """Check a block sent with submitblock, returning None if it's
+        accepted, or the reason it isn't (as bitcoind would).
+        """
+        self.stats['submitted'] += 1
+        header = block[:80]
+        try:
+            count, offset = readVarint(block, 80)
+            offset, coinbase = parseTransaction(block, offset)
+        except (IndexError, KeyError, ValueError):
+            count, coinbase = None, None
+        bits = self.TEMPLATE_BITS
+        target = (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+        branch = merkleBranch([doubleSHA(tx) for tx in self.transactions])
+
+        if coinbase is None or len(header) != 80:
+            reason = 'rejected'
+        elif header[4:36] != self.prevBlock:
+            reason = 'inconclusive-not-best-prevblk'
+        elif count != 1 + len(self.transactions) or \
+            block[offset:] != ''.join(self.transactions):
+            reason = 'bad-txns'
+        elif merkleRoot(coinbase, branch) != header[36:68]:
+            reason = 'bad-txnmrklroot'
+        elif self.witnessCommitment not in block:
+            reason = 'bad-witness-merkle-match'
+        elif int(doubleSHA(header)[::-1].encode('hex'), 16) > target:
+            reason = 'high-hash'
+        else:
+            self.stats['accepted'] += 1
+            print('Block %d solved' % self.blockNumber)
+            reactor.callLater(0, self.newBlock)
+            return None
+        self.stats['rejected'] += 1
+        return reason
+
+    def checkResult(self, data):
+        """Check submitted getwork-format data. Returns (accepted, reason)."""
+        header = swap32(data[:80])
+        return self.checkHeader(header, header[36:68] in self.issued)
+
+    def checkHeader(self, header, known):
+        """Check a submitted block header, where known says whether it was
+        built from work given out for the current block.
+        """
+        self.stats['submitted'] += 1
+        ntime, = unpack('<I', header[68:72])
+        if header[4:36] != self.prevBlock:
+            reason = 'stale'
+        elif not known:
+            reason = 'unknown-work'
+        elif abs(ntime - time()) > max(self.options.rollntime, 0) + 60:
+            reason = 'time-invalid'
+        else:
+            hash = doubleSHA(header)
+            if int(hash[::-1].encode('hex'), 16) > \
+                int(self.target[::-1].encode('hex'), 16):
+                reason = 'high-hash'
+            else:
+                self.stats['accepted'] += 1
+                return True, None
+        self.stats['rejected'] += 1
+        return False, reason
+
+    def delay(self):
+        """How long to wait before answering a request."""
+        latency = self.options.latency + random.uniform(0, self.options.jitter)
+        return max(0, latency) / 1000.0
+
+    def shouldFail(self):
+        if random.random() < self.options.errorrate:
+            self.stats['errors'] += 1
+            return True
+        return False
+
+    def shouldDisconnect(self):
+        if random.random() < self.options.disconnectrate:
+            self.stats['disconnects'] += 1
+            return True
+        return False
+
+    def printStats(self):
+        print(', '.join('%s=%d' % x for x in sorted(self.stats.items())))
+
+class RPCResource(resource.Resource):
+    """The getwork JSON-RPC endpoint."""
+
+    isLeaf = True
+
+    def __init__(self, pool):
+        resource.Resource.__init__(self)
+        self.pool = pool
+
+    def render_POST(self, request):
+        try:
+            call = json.loads(request.content.read())
+            method = call['method']
+            params = call.get('params', [])
+            id = call.get('id')
+        except (ValueError, KeyError, TypeError):
+            request.setResponseCode(400)
+            return ''
+
+        reactor.callLater(self.pool.delay(), self.respond, request, method,
+                          params, id)
+        return server.NOT_DONE_YET
+
+    def render_GET(self, request):
+        # Long polling: answer with new work when the next block comes out.
+        self.waitForBlock(request, self.sendWork, request, None)
+        return server.NOT_DONE_YET
+
+    def waitForBlock(self, request, function, *args):
+        """Call function once the next block comes out, unless the request
+        has gone away by then.
+        """
+        self.pool.stats['longpoll'] += 1
+        def listener(blockNumber):
+            self.pool.listeners.remove(listener)
+            if not request.finished and not request._disconnected:
+                function(*args)
+        self.pool.listeners.append(listener)
+        request.notifyFinish().addErrback(
+            lambda x: listener in self.pool.listeners and
+                      self.pool.listeners.remove(listener))
+
+    def sendWork(self, request, id):
+        self.pool.stats['getwork'] += 1
+        data = self.pool.makeWork()
+        work = {
+            'data': (data + GETWORK_PADDING).encode('hex'),
+            'target': self.pool.target.encode('hex'),
+        }
+        self.finish(request, work, None, id)
+
+    def respond(self, request, method, params, id):
+        if request._disconnected:
+            return
+
+        if self.pool.shouldDisconnect():
+            request.transport.loseConnection()
+            return
+
+        if self.pool.shouldFail():
+            self.finish(request, None,
+                        {'code': -1, 'message': 'Injected error'}, id)
+            return
+
+        if method == 'getblocktemplate':
+            # The request is answered at once unless it's a long poll for the
+            # current block, as with bitcoind.
+            options = params[0] if params and isinstance(params[0], dict) \
+                      else {}
+            if options.get('longpollid') == str(self.pool.blockNumber):
+                self.waitForBlock(request, lambda: self.finish(request,
+                    self.pool.makeTemplate(), None, id))
+            else:
+                self.finish(request, self.pool.makeTemplate(), None, id)
+        elif method == 'submitblock':
+            try:
+                block = params[0].decode('hex')
+            except (TypeError, ValueError, AttributeError, IndexError):
+                block = ''
+            self.finish(request, self.pool.checkBlock(block), None, id)
+        elif method != 'getwork':
+            self.finish(request, None,
+                        {'code': -32601, 'message': 'Method not found'}, id)
+        elif not params:
+            self.sendWork(request, id)
+        else:
+            try:
+                data = params[0].decode('hex')
+            except (TypeError, ValueError, AttributeError):
+                data = ''
+            if len(data) < 80:
+                self.finish(request, None,
+                            {'code': -1, 'message': 'Invalid data'}, id)
+                return
+            accepted, reason = self.pool.checkResult(data)
+            if reason is not None:
+                request.setHeader('X-Reject-Reason', reason)
+            self.finish(request, accepted, None, id)
+
+    def finish(self, request, result, error, id):
+        request.setHeader('Content-Type', 'application/json')
+        request.setHeader('X-Long-Polling', '/LP')
+        request.setHeader('X-Blocknum', str(self.pool.blockNumber))
+        if self.pool.options.rollntime > 0:
+            request.setHeader('X-Roll-NTime',
+                              'expire=%d' % self.pool.options.rollntime)
+        request.write(json.dumps({'result': result, 'error': error,
+                                  'id': id}))
+        request.finish()
+
+class SimulatedConnection(object):
+    """Latency and disconnects for the line-based server protocols."""
+
+    def later(self, function, *args):
+        """Run function after the simulated latency, possibly misbehaving."""
+        def run():
+            if not self.transport.connected:
+                return
+            if self.factory.pool.shouldDisconnect():
+                self.transport.loseConnection()
+            else:
+                function(*args)
+        reactor.callLater(self.factory.pool.delay(), run)
+
+class MMPServerProtocol(SimulatedConnection, MMPProtocolBase):
+    """The server side of an MMP connection. Speaks version 2 of the protocol
+    to clients that offer it, sending work with its midstate.
+    """
+
+    commands = {
+        'LOGIN':    (str, str),
+        'META':     (str, str),
+        'MORE':     (),
+        'RESULT':   (str,),
+        'WANT':     (int,),
+        'RESULTS':  (int, str),
+    }
+
+    loggedIn = False
+    version = 1
+
+    # The most units sent for one WANT, and in one WORKS line.
+    MAX_WANT = 256
+    MAX_BATCH = 32
+
+    def connectionMade(self):
+        self.factory.pool.listeners.append(self.blockChanged)
+
+    def connectionLost(self, reason):
+        if self.blockChanged in self.factory.pool.listeners:
+            self.factory.pool.listeners.remove(self.blockChanged)
+
+    def pushWork(self):
+        # Work the client didn't ask for always comes as WORK, so that it
+        # isn't taken for the answer to a WANT.
+        pool = self.factory.pool
+        pool.stats['getwork'] += 1
+        self.sendLine('WORK %s 32' % pool.makeWork().encode('hex'))
+
+    def sendWork(self, count=1):
+        pool = self.factory.pool
+        pool.stats['getwork'] += count
+        if self.version < 2:
+            for i in range(count):
+                self.sendLine('WORK %s 32' % pool.makeWork().encode('hex'))
+            return
+        while count > 0:
+            work = [pool.makeWork()
+                    for i in range(min(count, self.MAX_BATCH))]
+            midstates = calculateMidstates([data[:64] for data in work])
+            units = ['%s/%s' % (data.encode('hex'), midstate.encode('hex'))
+                     for data, midstate in zip(work, midstates)]
+            self.sendLine('WORKS 32 :' + ' '.join(units))
+            count -= len(units)
+
+    def blockChanged(self, blockNumber):
+        if self.loggedIn:
+            self.sendLine('BLOCK %d' % blockNumber)
+            self.pushWork()
+
+    def cmd_LOGIN(self, username, password):
+        def login():
+            self.loggedIn = True
+            pool = self.factory.pool
+            self.sendLine('TARGET %s' % pool.target.encode('hex'))
+            self.sendLine('TIME %d' % max(pool.options.rollntime, 0))
+            self.sendLine('BLOCK %d' % pool.blockNumber)
+            self.pushWork()
+        self.later(login)
+
+    def cmd_META(self, var, value):
+        if var == 'protocol':
+            try:
+                self.version = max(1, min(int(value), PROTOCOL_VERSION))
+            except ValueError:
+                return
+            self.sendLine('PROTO %d' % self.version)
+
+    def cmd_MORE(self):
+        if self.loggedIn:
+            self.later(self.sendWork)
+
+    def cmd_WANT(self, count):
+        if self.loggedIn and count > 0:
+            self.later(self.sendWork, min(count, self.MAX_WANT))
+
+    def checkResult(self, result):
+        """Returns whether the pool accepted a hex result, or None if it isn't
+        a result at all.
+        """
+        try:
+            data = result.decode('hex')
+        except (TypeError, ValueError):
+            return None
+        if len(data) < 80:
+            return None
+        accepted, reason = self.factory.pool.checkResult(data)
+        return accepted
+
+    def cmd_RESULT(self, result):
+        def check():
+            if self.factory.pool.shouldFail():
+                self.sendLine('MSG :Injected error')
+                return
+            accepted = self.checkResult(result)
+            if accepted is not None:
+                self.sendLine('%s %s' % ('ACCEPTED' if accepted else
+                                         'REJECTED', result))
+        self.later(check)
+
+    def cmd_RESULTS(self, firstId, results):
+        def check():
+            if self.factory.pool.shouldFail():
+                self.sendLine('MSG :Injected error')
+                return
+            acks = []
+            for i, result in enumerate(results.split()):
+                accepted = self.checkResult(result)
+                if accepted is not None:
+                    acks.append('%s%d' % ('+' if accepted else '-',
+                                          firstId + i))
+            if acks:
+                self.sendLine('ACKS :' + ' '.join(acks))
+        self.later(check)
+
+class MMPServerFactory(ServerFactory):
+    protocol = MMPServerProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+
+class StratumServerProtocol(SimulatedConnection, LineReceiver):
+    """The server side of a Stratum connection."""
+
+    delimiter = '\n'
+
+    EXTRANONCE2_SIZE = 4
+    MAX_JOBS = 16
+
+    subscribed = False
+
+    def connectionMade(self):
+        self.factory.extranonce1 += 1
+        self.extranonce1 = pack('>I', self.factory.extranonce1)
+        self.jobs = {}
+        self.nextJob = 0
+        self.factory.pool.listeners.append(self.blockChanged)
+
+    def connectionLost(self, reason):
+        if self.blockChanged in self.factory.pool.listeners:
+            self.factory.pool.listeners.remove(self.blockChanged)
+
+    def send(self, **message):
+        self.sendLine(json.dumps(message))
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+            id = message.get('id')
+            method = message['method']
+            params = message.get('params') or []
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        self.later(self.respond, id, method, params)
+
+    def respond(self, id, method, params):
+        pool = self.factory.pool
+        if pool.shouldFail():
+            self.send(id=id, result=None, error=[20, 'Injected error', None])
+            return
+
+        if method == 'mining.subscribe':
+            self.subscribed = True
+            self.send(id=id, result=[[['mining.notify', '%08x' % id]],
+                      self.extranonce1.encode('hex'),
+                      self.EXTRANONCE2_SIZE], error=None)
+        elif method == 'mining.authorize':
+            self.send(id=id, result=True, error=None)
+            self.send(id=None, method='mining.set_difficulty',
+                      params=[max(pool.options.difficulty, 1)])
+            self.sendJob(True)
+        elif method == 'mining.submit':
+            accepted, reason = self.checkSubmit(params)
+            if accepted:
+                self.send(id=id, result=True, error=None)
+            else:
+                self.send(id=id, result=None, error=[23, reason, None])
+        else:
+            self.send(id=id, result=None, error=[20, 'Unknown method', None])
+
+    def blockChanged(self, blockNumber):
+        if self.subscribed:
+            self.sendJob(True)
+
+    def sendJob(self, clean):
+        pool = self.factory.pool
+        self.nextJob += 1
+        jobId = '%x' % self.nextJob
+        # Old jobs are kept for a while, so late results are reported stale.
+        self.jobs.pop('%x' % (self.nextJob - self.MAX_JOBS), None)
+
+        # A BIP 34 coinbase, split around the extranonces.
+        tag = '/PoolSimulator/'
+        scriptLength = (4 + len(self.extranonce1) + self.EXTRANONCE2_SIZE +
+                        len(tag))
+        coinb1 = (pack('<I', 1) + '\x01' + '\x00'*32 + '\xff'*4 +
+                  chr(scriptLength) + '\x03' +
+                  pack('<I', pool.blockNumber)[:3])
+        coinb2 = (tag + '\xff'*4 + '\x01' + pack('<Q', 5000000000) + '\x00' +
+                  '\x00'*4)
+        branch = [os.urandom(32) for i in range(random.randint(0, 4))]
+        ntime = int(time())
+
+        self.jobs[jobId] = (coinb1, coinb2, branch, pool.prevBlock)
+        pool.stats['getwork'] += 1
+        self.send(id=None, method='mining.notify', params=[jobId,
+                  swap32(pool.prevBlock).encode('hex'),
+                  coinb1.encode('hex'), coinb2.encode('hex'),
+                  [h.encode('hex') for h in branch], '%08x' % 2,
+                  '%08x' % pool.BITS, '%08x' % ntime, clean])
+
+    def checkSubmit(self, params):
+        try:
+            username, jobId, extranonce2, ntime, nonce = params[:5]
+            extranonce2 = extranonce2.decode('hex')
+            ntime = int(ntime, 16)
+            nonce = int(nonce, 16)
+        except (ValueError, TypeError):
+            return False, 'invalid'
+
+        pool = self.factory.pool
+        if jobId not in self.jobs:
+            pool.stats['submitted'] += 1
+            pool.stats['rejected'] += 1
+            return False, 'unknown-work'
+
+        coinb1, coinb2, branch, prevBlock = self.jobs[jobId]
+        root = merkleRoot(coinb1 + self.extranonce1 + extranonce2 + coinb2,
+                          branch)
+        header = buildHeader(2, prevBlock, root, ntime, pool.BITS, nonce)
+        return pool.checkHeader(header, len(extranonce2) ==
+                                self.EXTRANONCE2_SIZE)
+
+class StratumServerFactory(ServerFactory):
+    protocol = StratumServerProtocol
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.extranonce1 = 0
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--rpcport', type='int', default=8332,
+        help='the port to serve getwork on (0 to disable)')
+    parser.add_option('--mmpport', type='int', default=8880,
+        help='the port to serve MMP on (0 to disable)')
+    parser.add_option('--stratumport', type='int', default=3333,
+        help='the port to serve Stratum on (0 to disable)')
+    parser.add_option('--blocktime', type='float', default=600,
+        help='seconds between new blocks (0 for never)')
+    parser.add_option('--difficulty', type='float', default=1,
+        help='the share difficulty (at least 1)')
+    parser.add_option('--rollntime', type='int', default=0,
+        help='how many seconds of ntime rolling to allow')
+    parser.add_option('--latency', type='float', default=0,
+        help='milliseconds to wait before answering each request')
+    parser.add_option('--jitter', type='float', default=0,
+        help='up to this many milliseconds of random extra latency')
+    parser.add_option('--errorrate', type='float', default=0,
+        help='fraction of requests to answer with an error')
+    parser.add_option('--disconnectrate', type='float', default=0,
+        help='fraction of requests to answer by disconnecting')
+    parser.add_option('--statsinterval', type='float', default=10,
+        help='seconds between printing statistics (0 to disable)')
+    options, args = parser.parse_args()
+
+    pool = Pool(options)
+    if options.rpcport:
+        reactor.listenTCP(options.rpcport, server.Site(RPCResource(pool)))
+    if options.mmpport:
+        reactor.listenTCP(options.mmpport, MMPServerFactory(pool))
+    if options.stratumport:
+        reactor.listenTCP(options.stratumport, StratumServerFactory(pool))
+    pool.start()
+    reactor.run()
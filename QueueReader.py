@@ -21,23 +21,144 @@
 
 from time import time
 from Queue import Queue, Empty
-from twisted.internet import reactor, defer
+from twisted.internet import defer
 
 from KernelInterface import CoreInterface
 
+class WorkSizeController(object):
+    """Decides how many nonces a QueueReader asks for at a time, aiming for
+    each execution to take latency seconds: long enough that the overhead of
+    an execution doesn't matter, short enough that the miner stays responsive.
+
+    The hashrate is smoothed over executions, and the size is only changed
+    when it's off by more than DEADBAND, by no more than a factor of MAX_STEP
+    at once, and no sooner than SETTLE executions after the last change (since
+    ranges of the old size are still on their way). Sizes are always whole
+    multiples of granularity, the nonces a device runs in one go (e.g.
+    WORKSIZE times the vector width). The QueueReader sets latency to the
+    miner's --latency, unless it's given here.
+    """
+
+    ALPHA = 0.3
+    DEADBAND = 0.15
+    MAX_STEP = 2.0
+    SETTLE = 3
+
+    def __init__(self, granularity=256, initial=None, maximum=0x100000000,
+                 latency=None):
+        self.latency = latency
+        self.maximum = maximum
+        self.setGranularity(granularity, initial)
+        self.rate = None
+        self.executions = 0
+        self.adjustments = 0
+
+    def setGranularity(self, granularity, initial=None):
+        """Kernels that only learn their granularity once the device is set
+        up can change it here.
+        """
+        self.granularity = max(1, granularity)
+        self.size = self._round(initial or self.granularity)
+
+    def _round(self, size):
+        multiples = min(int(round(float(size) / self.granularity)),
+                        self.maximum // self.granularity)
+        return self.granularity * max(1, multiples)
+
+    def getSize(self):
+        return self.size
+
+    def ranExecution(self, dt, size):
+        """Account for an execution of size nonces that took dt seconds.
+        Returns True if that changed the size.
+        """
+        if dt <= 0 or size <= 0:
+            return False
+
+        rate = size / dt
+        if self.rate is None:
+            self.rate = rate
+        else:
+            self.rate += self.ALPHA * (rate - self.rate)
+
+        self.executions += 1
+        if self.adjustments and self.executions < self.SETTLE:
+            return False
+
+        wanted = self.rate * self.latency
+        if abs(wanted - self.size) <= self.DEADBAND * self.size:
+            return False
+        # The first adjustment goes all the way, from whatever guess we
+        # started out with.
+        if self.adjustments:
+            wanted = min(max(wanted, self.size / self.MAX_STEP),
+                         self.size * self.MAX_STEP)
+
+        size = self._round(wanted)
+        if size == self.size:
+            return False
+        self.size = size
+        self.executions = 0
+        self.adjustments += 1
+        return True
+
+class CallbackController(object):
+    """Adapts an old-style workSizeCallback, which is handed the average of
+    the last SAMPLES execution times and the size of the latest range, and
+    returns the size to use, to the interface of a WorkSizeController.
+    """
+
+    SAMPLES = 3
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.samples = []
+        self.size = None
+        self.started = False
+
+    def getSize(self):
+        # The first call happens once the kernel has started.
+        if not self.started:
+            self.size = self.callback(None, None)
+            self.started = True
+        return self.size
+
+    def ranExecution(self, dt, size):
+        self.samples.append(dt)
+        self.samples = self.samples[-self.SAMPLES:]
+        if len(self.samples) < self.SAMPLES:
+            return False
+
+        oldSize = self.size
+        self.size = self.callback(sum(self.samples) / len(self.samples), size)
+        return self.size != oldSize
+
 class QueueReader(object):
     """A QueueReader is a very efficient WorkQueue reader that keeps the next
-    nonce range available at all times. The benefit is that threaded mining
-    kernels waste no time getting the next range, since this class will have it
-    completely requested and preprocessed for the next iteration.
+    few nonce ranges available at all times. The benefit is that threaded
+    mining kernels waste no time getting the next range, since this class will
+    have it completely requested and preprocessed for the next iteration.
+
+    How many ranges are kept ready (or on their way) is the prefetch depth,
+    which defaults to the miner's --prefetch option. A deeper prefetch rides
+    out a slow preprocess or a busy reactor, at the cost of more ranges being
+    thrown away when a new block comes out. Any time the mining thread does
+    spend waiting is added up in stallTime.
 
     The QueueReader is iterable, so a dedicated mining thread needs only to do
     for ... in self.qr:
-    """
 
-    SAMPLES = 3
+    The size of each range is up to a WorkSizeController, which kernels may
+    supply along with their granularity. Otherwise, one aiming for the miner's
+    --latency is used.
+
+    Ranges go stale when a new block comes out. Stale ones are never handed to
+    the mining thread, and kernels that run a range in several steps should
+    check stale() between them, to abandon the rest of the range at once.
+    """
 
-    def __init__(self, core, preprocessor=None, workSizeCallback=None):
+    def __init__(self, core, preprocessor=None, workSizeCallback=None,
+                 depth=None, controller=None):
         if not isinstance(core, CoreInterface):
             # Older kernels used to pass the KernelInterface, and not a
             # CoreInterface. This is deprecated. We'll go ahead and take care
@@ -55,12 +176,24 @@ class QueueReader(object):
             if not callable(self.workSizeCallback):
                 raise TypeError('the given workSizeCallback must be callable')
 
-        # This shuttles work to the dedicated thread.
+        # This shuttles work to the dedicated thread. It never holds more than
+        # depth items, counting those still being fetched or preprocessed.
+        if depth is None:
+            depth = self.interface.miner.options.getPrefetchDepth()
+        self.depth = max(1, depth)
         self.dataQueue = Queue()
-
-        # Used in averaging the last execution times.
-        self.executionTimeSamples = []
-        self.averageExecutionTime = None
+        self.pending = 0
+
+        # Older kernels tune the size themselves through workSizeCallback.
+        if controller is None:
+            if self.workSizeCallback is not None:
+                controller = CallbackController(self.workSizeCallback)
+            else:
+                controller = WorkSizeController()
+        if isinstance(controller, WorkSizeController) and \
+            controller.latency is None:
+            controller.latency = self.interface.miner.options.getLatency()
+        self.controller = controller
 
         # This gets changed by _updateWorkSize.
         self.executionSize = None
@@ -68,10 +201,14 @@ class QueueReader(object):
         # Statistics accessed by the dedicated thread.
         self.currentData = None
         self.startedAt = None
+        self.aborted = False
+        self.searched = 0 # How much of an aborted range was searched.
+        self.stalls = 0
+        self.stallTime = 0.0
 
     def start(self):
         """Called by the kernel when it's actually starting."""
-        self._updateWorkSize(None, None)
+        self._updateWorkSize()
         self._requestMore()
         # We need to know when the current NonceRange in the dataQueue is old.
         self.interface.addStaleCallback(self._staleCallback)
@@ -81,47 +218,69 @@ class QueueReader(object):
         the loop running in the mining thread.
         """
         # Tell the other thread to exit cleanly.
+        self._drain()
+        self.dataQueue.put(StopIteration())
+
+    def _drain(self, staleOnly=False):
+        """Empty the dataQueue (or with staleOnly, take just the stale items
+        out of it), giving back the ranges unsearched.
+        """
+        kept = []
         while not self.dataQueue.empty():
             try:
-                self.dataQueue.get(False)
+                item = self.dataQueue.get(False)
             except Empty:
-                pass
-        self.dataQueue.put(StopIteration())
-
-    def _ranExecution(self, dt, nr):
+                continue
+            if staleOnly and (isinstance(item, StopIteration) or
+                              not self._isStale(item)):
+                kept.append(item)
+            elif isinstance(item, StopIteration):
+                continue
+            else:
+                self.interface.releaseRange(item[1], False)
+        for item in kept:
+            self.dataQueue.put_nowait(item)
+
+    def _ranExecution(self, dt, nr, searched=None):
         """An internal function called after an execution completes, with the
-        time it took. Used to keep track of the time so kernels can use it to
-        tune their execution times.
+        time it took. Used to keep track of the rate, and to tune the size of
+        later executions. An execution that was cut short only searched the
+        first searched nonces, and doesn't say anything about the size.
         """
 
-        if dt > 0:
-            self.core.updateRate(int(nr.size/dt/1000))
+        if searched is None:
+            searched = nr.size
+            if self.controller.ranExecution(dt, nr.size):
+                self._updateWorkSize()
+                self.interface.debug('Execution size now %d nonces' %
+                                     self.executionSize)
 
-        self.executionTimeSamples.append(dt)
-        self.executionTimeSamples = self.executionTimeSamples[-self.SAMPLES:]
+        if dt > 0 and searched:
+            self.core.updateRate(int(searched/dt/1000))
 
-        if len(self.executionTimeSamples) == self.SAMPLES:
-            averageExecutionTime = (sum(self.executionTimeSamples) /
-                                    len(self.executionTimeSamples))
+        stats = self.interface.miner.stats
+        if stats is not None:
+            stats.count('hashes', searched)
 
-            self._updateWorkSize(averageExecutionTime, nr.size)
+        self.interface.releaseRange(nr, searched)
 
-    def _updateWorkSize(self, time, size):
-        """An internal function that tunes the executionSize to that specified
-        by the workSizeCallback; which is in turn passed the average of the
-        last execution times.
+    def _updateWorkSize(self):
+        """An internal function that picks up the executionSize decided on by
+        the controller.
         """
-        if self.workSizeCallback:
-            self.executionSize = self.workSizeCallback(time, size)
+        self.executionSize = self.controller.getSize()
 
     def _requestMore(self):
-        """This is used to start the process of making a new item available in
-        the dataQueue, so the dedicated thread doesn't have to block.
+        """This is used to start the process of making new items available in
+        the dataQueue, so the dedicated thread doesn't have to block. Enough
+        are requested to bring it up to the prefetch depth.
         """
 
-        # This should only run if there's no ready-to-go work in the queue.
-        if not self.dataQueue.empty():
-            return
+        for i in range(self.depth - self.dataQueue.qsize() - self.pending):
+            self._requestOne()
+
+    def _requestOne(self):
+        self.pending += 1
 
         if self.executionSize is None:
             d = self.interface.fetchRange()
@@ -133,32 +292,61 @@ class QueueReader(object):
             if not self.preprocessor:
                 return (nr, nr)
 
+            started = time()
             d2 = defer.maybeDeferred(self.preprocessor, nr)
 
             # Tuplize the preprocessed result.
             def callback(x):
+                stats = self.interface.miner.stats
+                if stats is not None:
+                    stats.record('preprocess', time() - started)
                 return (x, nr)
-            d2.addCallback(callback)
+            def errback(failure):
+                self.interface.releaseRange(nr, False)
+                return failure
+            d2.addCallbacks(callback, errback)
             return d2
         d.addCallback(preprocess)
 
-        d.addCallback(self.dataQueue.put_nowait)
+        def store(item):
+            self.pending -= 1
+            # A new block may have come out while the range was preprocessed.
+            if self._isStale(item):
+                self.interface.releaseRange(item[1], False)
+                self._requestMore()
+            else:
+                self.dataQueue.put_nowait(item)
+        def failed(failure):
+            self.pending -= 1
+            return failure
+        d.addCallbacks(store, failed)
+
+    def _isStale(self, item):
+        # item[1] is the un-preprocessed NonceRange.
+        return self.interface.miner.queue.isRangeStale(item[1])
+
+    def stale(self, searched):
+        """Called by the mining thread before each step of an execution but
+        the first, with how many nonces of the range the steps so far have
+        searched, to see whether the range has gone stale. If it has, the
+        kernel should stop working on it and move on to the next.
+        """
+        if self.currentData is not None and self._isStale(self.currentData):
+            self.aborted = True
+            self.searched = searched
+        return self.aborted
 
     def _staleCallback(self):
-        """Called when the WorkQueue gets new work, rendering whatever is in
-        dataQueue old.
+        """Called when a pool moves to a new block, rendering whatever is in
+        dataQueue from that pool old.
         """
 
-        #only clear queue and request more if no work present, since that
-        #meas a request for more work is already in progress
-        if not self.dataQueue.empty():
-            # Out with the old...
-            while not self.dataQueue.empty():
-                try:
-                    self.dataQueue.get(False)
-                except Empty: continue
-            # ...in with the new.
-            self._requestMore()
+        # Out with the old... (Items still on their way are checked when they
+        # arrive, and replaced then if they're stale. Those from other pools
+        # are still good, and stay.)
+        self._drain(True)
+        # ...in with the new.
+        self._requestMore()
 
     def __iter__(self):
         return self
@@ -170,25 +358,57 @@ class QueueReader(object):
         main thread.
         """
 
-        # If we just completed a range, we should tell the main thread.
+        # If we just completed a range, we should tell the main thread. (An
+        # abandoned range only reports the part of it that was searched.)
         now = time()
         if self.currentData:
             dt = now - self.startedAt
             # self.currentData[1] is the un-preprocessed NonceRange.
-            reactor.callFromThread(self._ranExecution, dt, self.currentData[1])
+            if self.aborted:
+                self.interface.channel.post(self._ranExecution, dt,
+                                            self.currentData[1], self.searched)
+            else:
+                self.interface.channel.post(self._ranExecution, dt,
+                                            self.currentData[1])
         self.startedAt = now
+        self.aborted = False
 
         # Block for more data from the main thread. In 99% of cases, though,
         # there should already be something here.
         # Note that this comes back with either a tuple, or a StopIteration()
-        self.currentData = self.dataQueue.get(True)
+        # Anything that went stale while it waited is dropped.
+        stalled = 0
+        while True:
+            try:
+                self.currentData = self.dataQueue.get(False)
+            except Empty:
+                stalledAt = time()
+                self.currentData = self.dataQueue.get(True)
+                stalled += time() - stalledAt
+            if isinstance(self.currentData, StopIteration) or \
+                not self._isStale(self.currentData):
+                break
+            self.interface.channel.post(self.interface.releaseRange,
+                                        self.currentData[1], False)
+            self.interface.channel.postOnce(self._requestMore)
+
+        if stalled:
+            self.stalls += 1
+            self.stallTime += stalled
+
+        stats = self.interface.miner.stats
+        if stats is not None:
+            stats.record('dispatch', time() - now)
+            if stalled:
+                stats.record('stall', stalled)
 
         # Does the main thread want us to shut down, or pass some more data?
         if isinstance(self.currentData, StopIteration):
             raise self.currentData
 
-        # We just took the only item in the queue. It needs to be restocked.
-        reactor.callFromThread(self._requestMore)
+        # We just took an item from the queue. It needs to be restocked. (This
+        # goes over with the report above, in one trip to the main thread.)
+        self.interface.channel.postOnce(self._requestMore)
 
         # currentData is actually a tuple, with item 0 intended for the kernel.
         return self.currentData[0]
\ No newline at end of file
@@ -0,0 +1,230 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+from time import time
+from struct import unpack
+from collections import OrderedDict
+from twisted.internet import reactor, defer
+
+from minerutil.ClientBase import WorkExpired
+from minerutil.FileUtil import replaceFile
+
+class PendingResult(object):
+    """A result that the server hasn't given an answer for yet."""
+
+    def __init__(self, result, urgent):
+        self.result = result
+        self.urgent = urgent
+        self.deferreds = []
+        self.delay = ShareJournal.INITIAL_DELAY
+        self.attempts = 0
+        self.retryCall = None
+
+    def age(self):
+        """How many seconds ago (by its ntime) this result was found."""
+        ntime, = unpack('>I', self.result[68:72])
+        return time() - ntime
+
+class ShareJournal(object):
+    """Keeps every result in an append-only file until the server has either
+    accepted or rejected it, so that results survive both pool outages and
+    restarts. Results that can't be delivered are retried with exponential
+    backoff (and immediately upon reconnecting), until their ntime is more
+    than MAX_AGE seconds old.
+
+    The journal is a text file with one record per line:
+        S <result> [U]  a result was found (U if it is a block)
+        A <result>      the server accepted it
+        R <result>      the server rejected it
+        E <result>      it expired before it could be delivered
+    where <result> is the hex of the 80 bytes sent to the server. Results the
+    connection says can no longer be submitted (WorkExpired) expire as well.
+    On startup, any results without an A, R or E record are submitted again,
+    and the file is rewritten to contain only those. It's rewritten the same
+    way whenever COMPACT_AFTER outcomes have been recorded, so it can't grow
+    without bound.
+    """
+
+    INITIAL_DELAY = 1
+    MAX_DELAY = 60
+    MAX_AGE = 600
+    COMPACT_AFTER = 1000
+
+    def __init__(self, miner, path):
+        self.miner = miner
+        self.path = path
+        self.pending = OrderedDict()
+        self.file = None
+        self.outcomes = 0 # Recorded since the journal was last compacted.
+
+    def open(self):
+        """Open the journal, replaying any results left over from last time."""
+        leftover = self._load()
+        self._compact(leftover)
+        if leftover:
+            self.miner.logger.log('Resubmitting %d result(s) from the share '
+                                  'journal' % len(leftover))
+        for result, urgent in leftover:
+            self._add(result, urgent, None)
+
+    def close(self):
+        for pending in self.pending.values():
+            if pending.retryCall is not None and pending.retryCall.active():
+                pending.retryCall.cancel()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _load(self):
+        """Return [(result, urgent)] for each result with no outcome recorded,
+        in the order they were found.
+        """
+        found = []
+        outcomes = set()
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return []
+        with f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 2:
+                    continue # Probably torn by a crash; skip it.
+                try:
+                    result = fields[1].decode('hex')
+                except (TypeError, ValueError):
+                    continue
+                if len(result) != 80:
+                    continue
+                if fields[0] == 'S':
+                    found.append((result, fields[2:] == ['U']))
+                elif fields[0] in ('A', 'R', 'E'):
+                    outcomes.add(result)
+
+        leftover = []
+        seen = set()
+        for result, urgent in found:
+            if result not in outcomes and result not in seen:
+                seen.add(result)
+                leftover.append((result, urgent))
+        return leftover
+
+    def _compact(self, leftover):
+        """Rewrite the journal so that it only contains leftover, and (re)open
+        it for appending.
+        """
+        if self.file is not None:
+            self.file.close()
+        try:
+            replaceFile(self.path, ''.join(self._format('S', result, urgent)
+                                           for result, urgent in leftover))
+        except (IOError, OSError), e:
+            # The old journal is still intact, so just keep appending to it.
+            self.miner.logger.reportDebug('Failed to compact the share '
+                                          'journal: %s' % e)
+        self.file = open(self.path, 'ab')
+        self.outcomes = 0
+
+    def _format(self, kind, result, urgent=False):
+        return '%s %s%s\n' % (kind, result.encode('hex'),
+                              ' U' if urgent else '')
+
+    def _write(self, kind, result, urgent=False, sync=False):
+        if self.file is None:
+            return
+        self.file.write(self._format(kind, result, urgent))
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+
+    def submit(self, result, urgent=False):
+        """Journal a result and send it to the server. Returns a Deferred that
+        fires with whether it was accepted, once the server has decided (or
+        with False if the result expires first).
+        """
+        d = defer.Deferred()
+        if result in self.pending:
+            self.pending[result].deferreds.append(d)
+            return d
+        self._write('S', result, urgent, True)
+        self._add(result, urgent, d)
+        return d
+
+    def _add(self, result, urgent, d):
+        pending = PendingResult(result, urgent)
+        if d is not None:
+            pending.deferreds.append(d)
+        self.pending[result] = pending
+        self._send(pending)
+
+    def retryNow(self):
+        """Resubmit everything waiting for a retry, e.g. upon reconnecting."""
+        for pending in self.pending.values():
+            if pending.retryCall is not None and pending.retryCall.active():
+                pending.retryCall.cancel()
+                pending.delay = self.INITIAL_DELAY
+                self._send(pending)
+
+    def _send(self, pending):
+        pending.retryCall = None
+        if pending.age() > self.MAX_AGE:
+            self.miner.logger.reportDebug('Result expired after %d '
+                                          'attempt(s)' % pending.attempts)
+            self._finish(pending, 'E', False)
+            return
+
+        connection = self.miner.connection
+        if connection is None:
+            self._retryLater(pending)
+            return
+
+        pending.attempts += 1
+        d = connection.sendResult(pending.result, pending.urgent)
+
+        def callback(accepted):
+            self._finish(pending, 'A' if accepted else 'R', accepted)
+        def errback(failure):
+            if failure.check(WorkExpired):
+                self.miner.logger.reportDebug('Result expired: %s' %
+                                              failure.getErrorMessage())
+                self._finish(pending, 'E', False)
+                return
+            self.miner.logger.reportDebug('Failed to submit result (%s), '
+                'retrying in %d seconds' % (failure.getErrorMessage(),
+                                            pending.delay))
+            self._retryLater(pending)
+        d.addCallbacks(callback, errback)
+
+    def _retryLater(self, pending):
+        pending.retryCall = reactor.callLater(pending.delay, self._send,
+                                              pending)
+        pending.delay = min(pending.delay * 2, self.MAX_DELAY)
+
+    def _finish(self, pending, kind, accepted):
+        self._write(kind, pending.result)
+        del self.pending[pending.result]
+        self.outcomes += 1
+        if self.file is not None and self.outcomes >= self.COMPACT_AFTER:
+            self._compact([(p.result, p.urgent)
+                           for p in self.pending.values()])
+        for d in pending.deferreds:
+            d.callback(accepted)
@@ -20,8 +20,37 @@
 # THE SOFTWARE.
 
 from minerutil.Midstate import calculateMidstate
-from twisted.internet import defer
+from twisted.internet import reactor, defer
 from collections import deque
+from bisect import bisect_left
+from struct import pack, unpack
+from time import time
+from math import ceil
+
+# The target corresponding to difficulty 1.
+DIFFICULTY_1 = 0xFFFF << 208
+
+# The possible results of WorkUnit.classifyHash.
+HASH_INVALID = 0
+HASH_SHARE = 1
+HASH_BLOCK = 2
+
+def targetToInt(target):
+    """Convert a 256-bit little endian string (a hash or a target) to an
+    integer.
+    """
+    return int(target[::-1].encode('hex'), 16)
+
+def bitsToTarget(bits):
+    """Expand the compact "bits" representation of the network target."""
+    exponent = bits >> 24
+    mantissa = bits & 0x7FFFFF
+    if exponent <= 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+def targetToDifficulty(target):
+    return DIFFICULTY_1 / float(max(1, target))
 
 """A WorkUnit is a single unit containing 2^32 nonces. A single getWork
 request returns a WorkUnit.
@@ -33,21 +62,216 @@ class WorkUnit(object):
     nonces = None
     base = None
     identifier = None
+    pool = None # Which of the PoolManager's pools this came from, if any.
+    prefixHash = None # Cached by KernelInterface, see calculateHash.
+    maxtime = None # The highest ntime the server accepts for this work.
+    expires = None # When (local time) the server stops accepting rolled work.
+
+    # These are filled in by setTargets.
+    targetValue = None
+    networkTarget = None
+    difficulty = None
+    networkDifficulty = None
+
+    def __init__(self, shared=None):
+        # Values precomputed by kernels, see precompute. The shared ones are
+        # also used by every WorkUnit rolled from this one.
+        self.precomputed = {}
+        self.sharedPrecomputed = {} if shared is None else shared
+
+        # The nonces searched so far, as a sorted list of disjoint (start,
+        # end) intervals; see cover. Also how many of this unit's NonceRanges
+        # are leased out, and whether the WorkQueue is done handing them out.
+        self.coverage = []
+        self.leases = 0
+        self.exhausted = False
+
+    def precompute(self, key, function, shared=False):
+        """Return function(self), only calling it the first time a given key
+        is asked for. Kernels use this for data that depends only on the
+        WorkUnit, so that it is shared by all of the unit's NonceRanges.
+
+        Pass shared=True for data that depends only on the midstate (and not
+        on ntime), which can then be reused by rolled WorkUnits as well.
+        """
+        cache = self.sharedPrecomputed if shared else self.precomputed
+        try:
+            return cache[key]
+        except KeyError:
+            value = cache[key] = function(self)
+            return value
+
+    def cover(self, base, size):
+        """Mark the nonces from base to base+size as searched. Ranges are
+        mostly searched in order, so the coverage stays just a few intervals.
+        """
+        start, end = base, base + size
+        i = bisect_left(self.coverage, (start, start))
+        if i and self.coverage[i-1][1] >= start:
+            i -= 1
+            start = self.coverage[i][0]
+        j = i
+        while j < len(self.coverage) and self.coverage[j][0] <= end:
+            end = max(end, self.coverage[j][1])
+            j += 1
+        self.coverage[i:j] = [(start, end)]
+
+    def searched(self):
+        """How many of this unit's nonces have been searched."""
+        return sum(end - start for start, end in self.coverage)
+
+    def setTargets(self):
+        """Precompute the share and network targets as integers, along with
+        the difficulties they correspond to. Requires data and target.
+        """
+        self.targetValue = targetToInt(self.target)
+        self.difficulty = targetToDifficulty(self.targetValue)
+
+        # The bits field is byteswapped, like the rest of the header.
+        bits, = unpack('>I', self.data[72:76])
+        self.networkTarget = bitsToTarget(bits)
+        self.networkDifficulty = targetToDifficulty(self.networkTarget)
+
+    def classifyHash(self, hash):
+        """Classify a hash of this unit's header as HASH_INVALID, HASH_SHARE
+        or HASH_BLOCK (which also meets the share target, as far as the
+        server is concerned).
+        """
+        value = targetToInt(hash)
+        if value <= self.networkTarget:
+            return HASH_BLOCK
+        elif value <= self.targetValue:
+            return HASH_SHARE
+        return HASH_INVALID
 
 """A NonceRange is a range of nonces from a WorkUnit, to be dispatched in a
 single execution of a mining kernel. The size of the NonceRange can be
 adjusted to tune the performance of the kernel.
 
+Each NonceRange is a lease on its nonces: once the core is done with it, it
+goes back to WorkQueue.releaseRange (QueueReader takes care of that), saying
+how many of its nonces, counting from the base, were searched.
+
 This class doesn't actually do anything, it's just a well-defined container
 that kernels can pull information out of.
 """
 class NonceRange(object):
 
-    def __init__(self, unit, base, size):
+    def __init__(self, unit, base, size, epoch=0):
         self.unit = unit # The WorkUnit this NonceRange comes from.
         self.base = base # The base nonce.
         self.size = size # How many nonces this NonceRange says to test.
+        self.epoch = epoch # The WorkQueue's epoch when it was dispatched.
+        self.released = False # Whether the lease has been given back.
+
 
+class FetchController(object):
+    """Decides when the WorkQueue should ask the server for more work, so that
+    it arrives just as the queue would otherwise run dry.
+
+    It keeps moving averages of how long the miner takes to use up a WorkUnit
+    (rolled ntime included) and of the round trip time for work, with the
+    RTT's mean deviation, as TCP does. A fetch is started once the work on
+    hand would last no longer than the expected round trip plus four
+    deviations plus margin seconds. Until there are samples of both, the
+    queue is simply kept full.
+    """
+
+    ALPHA = 0.125
+    BETA = 0.25
+
+    # The longest a request for work can take and still be measured.
+    MAX_RTT = 60
+
+    def __init__(self, queue, margin):
+        self.queue = queue
+        self.margin = margin
+        self.unitTime = None # Seconds to use up a WorkUnit.
+        self.rtt = None # Seconds from asking for work to getting it.
+        self.rttDeviation = 0.0
+        self.startedAt = None # When the current WorkUnit was started.
+        self.requests = deque() # When each unit on its way was asked for.
+        self.fetchCall = None
+
+    def unitStarted(self):
+        """Called when a WorkUnit is taken from the queue, which is also when
+        the previous one was used up.
+        """
+        now = time()
+        if self.startedAt is not None:
+            sample = now - self.startedAt
+            if self.unitTime is None:
+                self.unitTime = sample
+            else:
+                self.unitTime += self.ALPHA * (sample - self.unitTime)
+        self.startedAt = now
+
+    def unitAbandoned(self):
+        """The current WorkUnit was dropped for a new block, so its time isn't
+        a sample.
+        """
+        self.startedAt = None
+
+    def workArrived(self):
+        now = time()
+        # Requests that never got an answer (e.g. failed) aren't samples.
+        while self.requests and now - self.requests[0] > self.MAX_RTT:
+            self.requests.popleft()
+        if not self.requests:
+            return # Pushed, or polled for by the connection itself.
+        sample = now - self.requests.popleft()
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttDeviation = sample / 2
+        else:
+            self.rttDeviation += self.BETA * (abs(sample - self.rtt) -
+                                              self.rttDeviation)
+            self.rtt += self.ALPHA * (sample - self.rtt)
+
+    def leadTime(self):
+        return self.rtt + 4 * self.rttDeviation + self.margin
+
+    def supply(self):
+        """Estimate how many seconds the queued work will last."""
+        queue = self.queue
+        remaining = 0
+        if queue.currentUnit is not None and self.startedAt is not None:
+            remaining = max(0, self.unitTime - (time() - self.startedAt))
+        return len(queue.queue) * self.unitTime + remaining
+
+    def schedule(self):
+        """Fetch work now if it's needed, or arrange to when it will be."""
+        if self.fetchCall is not None and self.fetchCall.active():
+            self.fetchCall.cancel()
+        self.fetchCall = None
+
+        queue = self.queue
+        room = queue.queueSize - len(queue.queue)
+        if room <= 0:
+            return
+        if self.unitTime is None or self.rtt is None:
+            self.fetch(room)
+            return
+
+        lead = self.leadTime()
+        supply = self.supply()
+        if supply <= lead:
+            # Enough to cover the shortfall, in whole units.
+            needed = int(ceil((lead - supply) / max(self.unitTime, 0.001)))
+            self.fetch(max(1, min(room, needed)))
+        else:
+            self.fetchCall = reactor.callLater(supply - lead, self.schedule)
+
+    def fetch(self, count):
+        if self.fetchCall is not None and self.fetchCall.active():
+            self.fetchCall.cancel()
+        self.fetchCall = None
+        # Connections make sure count units are on their way, rather than
+        # asking for count more.
+        now = time()
+        for i in range(count - len(self.requests)):
+            self.requests.append(now)
+        self.queue.miner.connection.requestWork(count)
 
 class WorkQueue(object):
     """A WorkQueue contains WorkUnits and dispatches NonceRanges when requested
@@ -59,49 +283,67 @@ class WorkQueue(object):
         self.miner = miner
         self.queueSize = options.getQueueSize()
         self.logger = options.makeLogger(self, miner)
+        self.fetcher = FetchController(self, options.getFetchMargin())
 
         self.queue = deque('', self.queueSize)
         self.deferredQueue = deque()
         self.currentUnit = None
-        self.block = ''
-        self.lastBlock = None
+
+        # The current and previous block identifiers, for each pool. Without
+        # a PoolManager, the only pool is None.
+        self.blocks = {}
+        self.lastBlocks = {}
+
+        # The epoch goes up with every new block, and every NonceRange is
+        # stamped with it. A range is stale if its pool has had a new block
+        # since, i.e. it's older than the pool's entry in staleEpochs.
+        self.epoch = 0
+        self.staleEpochs = {}
+
+        # Leased NonceRanges that were given back without being searched, to
+        # be dispatched again. And where all the leased nonces ended up:
+        # searched (some after their work went stale), abandoned as stale
+        # before being searched, or dispatched a second time.
+        self.returned = deque()
+        self.noncesSearched = 0
+        self.noncesStale = 0
+        self.noncesAbandoned = 0
+        self.noncesRedispatched = 0
 
         # This is set externally. Not the best practice, but it can be changed
         # in the future.
         self.staleCallbacks = []
 
-    # Called by foundNonce to check if a NonceRange is stale before submitting
+    # Called by foundNonce to check if a NonceRange is stale before submitting,
+    # and by QueueReaders (from mining threads, too) to abandon stale ranges
     def isRangeStale(self, nr):
-        return (nr.unit.identifier != self.block)
+        return nr.epoch < self.staleEpochs.get(nr.unit.pool, 0)
 
     def storeWork(self, aw):
 
         #check if this work matches the previous block
-        if self.lastBlock is not None and (aw.identifier == self.lastBlock):
+        lastBlock = self.lastBlocks.get(aw.pool)
+        if lastBlock is not None and (aw.identifier == lastBlock):
             self.logger.reportDebug('Server gave work from the previous '
                                     'block, ignoring.')
-            #if the queue is too short request more work
-            if (len(self.queue)) < (self.queueSize):
-                self.miner.connection.requestWork()
+            self.fetcher.schedule()
             return
 
         #create a WorkUnit
         work = WorkUnit()
         work.data = aw.data
         work.target = aw.target
-        work.midstate = calculateMidstate(work.data[:64])
+        work.midstate = aw.midstate or calculateMidstate(work.data[:64])
         work.nonces = 2 ** aw.mask
         work.base = 0
         work.identifier = aw.identifier
+        work.pool = aw.pool
+        work.maxtime = aw.maxtime
+        work.expires = time() + (aw.time or 0)
+        work.setTargets()
 
-        #check if there is a new block, if so reset queue
-        newBlock = (aw.identifier != self.block)
-        if newBlock:
-            self.queue.clear()
-            self.currentUnit = None
-            self.lastBlock = self.block
-            self.block = aw.identifier
-            self.logger.reportDebug("New block (WorkQueue)")
+        #check if there is a new block, if so drop that pool's queued work
+        newBlock = self.newBlock(aw.pool, aw.identifier)
 
         #clear the idle flag since we just added work to queue
         self.miner.reportIdle(False)
@@ -110,14 +352,14 @@ class WorkQueue(object):
         if work.data and work.target and work.midstate and work.nonces:
             self.queue.append(work)
 
-        #if the queue is too short request more work
-        if (len(self.queue)) < (self.queueSize):
-            self.miner.connection.requestWork()
+        #ask for more work when it will be needed (after a new block, that's
+        #the whole queue at once, in a single round trip)
+        self.fetcher.workArrived()
+        self.fetcher.schedule()
 
         #if there is a new block notify kernels that their work is now stale
         if newBlock:
-            for callback in self.staleCallbacks:
-                callback()
+            self.notifyStale()
 
         #check if there are deferred NonceRange requests pending
         #since requests to fetch a NonceRange can add additional deferreds to
@@ -127,36 +369,173 @@ class WorkQueue(object):
             d = self.fetchRange(size)
             d.chainDeferred(df)
 
+    #called when pool's work is identified by identifier; if that means a new
+    #block, drops the pool's queued work and makes its leased NonceRanges
+    #stale, returning True (kernels are told by notifyStale)
+    def newBlock(self, pool, identifier):
+        block = self.blocks.get(pool, '')
+        if identifier == block:
+            return False
+        self.dropWork(pool)
+        self.lastBlocks[pool] = block
+        self.blocks[pool] = identifier
+        self.epoch += 1
+        self.staleEpochs[pool] = self.epoch
+        self.logger.reportDebug("New block (WorkQueue)")
+        return True
+
+    #tells the kernels that some of their work is now stale
+    def notifyStale(self):
+        for callback in self.staleCallbacks:
+            callback()
+
+    #removes every queued WorkUnit that came from pool
+    def dropWork(self, pool):
+        kept = [unit for unit in self.queue if unit.pool is not pool]
+        self.queue.clear()
+        self.queue.extend(kept)
+        if self.currentUnit is not None and self.currentUnit.pool is pool:
+            self.fetcher.unitAbandoned()
+            self.retireUnit(self.currentUnit)
+            self.currentUnit = None
+
+    #called when no more NonceRanges will be leased from a WorkUnit
+    def retireUnit(self, unit):
+        unit.exhausted = True
+        if unit.leases:
+            return
+
+        #every lease is back, so its coverage is final
+        searched = unit.searched()
+        if searched < unit.nonces:
+            self.logger.reportDebug('WorkUnit retired with %d of %d nonces '
+                                    'searched (%d abandoned in total)' %
+                                    (searched, unit.nonces,
+                                     self.noncesAbandoned))
+
+    #takes back a leased NonceRange, see NonceRange; searched is True, False
+    #or how many nonces from the base were searched
+    def releaseRange(self, nr, searched):
+        if nr.released:
+            return
+        nr.released = True
+
+        if searched is True:
+            searched = nr.size
+        searched = max(0, min(int(searched), nr.size))
+
+        #someone else can search the rest, under the same lease on the unit
+        if searched < nr.size and not self.isRangeStale(nr):
+            self.countNonces(nr, searched, 0)
+            self.returned.append(NonceRange(nr.unit, nr.base + searched,
+                                            nr.size - searched, nr.epoch))
+        else:
+            self.endLease(nr, searched)
+
+    #accounts for the first searched nonces of nr as searched, and the next
+    #abandoned ones as given up on
+    def countNonces(self, nr, searched, abandoned):
+        stats = self.miner.stats
+        if searched:
+            nr.unit.cover(nr.base, searched)
+            self.noncesSearched += searched
+            if stats is not None:
+                stats.count('searched', searched)
+            if self.isRangeStale(nr):
+                self.noncesStale += searched
+                if stats is not None:
+                    stats.count('stale', searched)
+        if abandoned:
+            self.noncesAbandoned += abandoned
+            if stats is not None:
+                stats.count('abandoned', abandoned)
+
+    #accounts for the nonces of a lease that's over
+    def endLease(self, nr, searched):
+        self.countNonces(nr, searched, nr.size - searched)
+        nr.unit.leases -= 1
+        if nr.unit.exhausted:
+            self.retireUnit(nr.unit)
+
+    #leases out a range given back unsearched, if there is one that's not
+    #stale
+    def getReturnedRange(self):
+        while self.returned:
+            old = self.returned.popleft()
+            if self.isRangeStale(old):
+                self.endLease(old, 0)
+                continue
+
+            nr = NonceRange(old.unit, old.base, old.size, self.epoch)
+            self.noncesRedispatched += nr.size
+            stats = self.miner.stats
+            if stats is not None:
+                stats.count('redispatched', nr.size)
+            return nr
+        return None
+
+    #creates a new WorkUnit by incrementing the ntime of an exhausted one
+    def rollUnit(self, unit):
+
+        #the server must allow ntime rolling, and only for a limited time
+        if unit.maxtime is None or unit.expires is None:
+            return None
+        ntime, = unpack('>I', unit.data[68:72])
+        if ntime >= unit.maxtime or time() >= unit.expires:
+            return None
+
+        #ntime is in the second SHA-256 block, so the midstate is unchanged
+        work = WorkUnit(unit.sharedPrecomputed)
+        work.data = unit.data[:68] + pack('>I', ntime + 1) + unit.data[72:]
+        work.target = unit.target
+        work.midstate = unit.midstate
+        work.nonces = unit.nonces
+        work.base = 0
+        work.identifier = unit.identifier
+        work.pool = unit.pool
+        work.maxtime = unit.maxtime
+        work.expires = unit.expires
+        work.setTargets()
+        return work
+
     #gets the next WorkUnit from queue
     def getNext(self):
 
-        #check if the queue will fall below desired size
-        if (len(self.queue) - 1) < (self.queueSize):
-            self.miner.connection.requestWork()
-
-        #return next WorkUnit
-        return self.queue.popleft()
+        #take the next WorkUnit, then see when the queue needs topping up
+        unit = self.queue.popleft()
+        self.fetcher.unitStarted()
+        self.fetcher.schedule()
+        return unit
 
     def getRangeFromUnit(self, size):
 
+        #the range is leased out of the current unit
+        unit = self.currentUnit
+        unit.leases += 1
+
         #get remaining nonces
         noncesLeft = self.currentUnit.nonces - self.currentUnit.base
 
         #if there are enough nonces to fill the full reqest
         if noncesLeft >= size:
-            nr = NonceRange(self.currentUnit, self.currentUnit.base, size)
+            nr = NonceRange(self.currentUnit, self.currentUnit.base, size,
+                            self.epoch)
 
             #check if this uses up the rest of the WorkUnit
             if size >= noncesLeft:
-                self.currentUnit = None
+                self.currentUnit = self.rollUnit(self.currentUnit)
             else:
                 self.currentUnit.base += size
 
         #otherwise send whatever is left
         else:
-            nr = NonceRange(
-                self.currentUnit, self.currentUnit.base, noncesLeft)
-            self.currentUnit = None
+            nr = NonceRange(self.currentUnit, self.currentUnit.base,
+                            noncesLeft, self.epoch)
+            self.currentUnit = self.rollUnit(self.currentUnit)
+
+        #no more ranges come out of a unit once it's used up
+        if self.currentUnit is not unit:
+            self.retireUnit(unit)
 
         #return the range
         return nr
@@ -169,6 +548,11 @@ class WorkQueue(object):
         #make sure size is not too small
         size = max(size, 256)
 
+        #ranges that were given back come first, whatever their size
+        nr = self.getReturnedRange()
+        if nr is not None:
+            return defer.succeed(nr)
+
         #check if the current unit exists
         if self.currentUnit is not None:
 
@@ -195,8 +579,8 @@ class WorkQueue(object):
             #if the queue is empty
             else:
 
-                #request more work
-                self.miner.connection.requestWork()
+                #request more work right away
+                self.fetcher.fetch(self.queueSize)
 
                 #report that the miner is idle
                 self.miner.reportIdle(True)
@@ -0,0 +1,188 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import multiprocessing
+import platform
+
+from time import time
+from struct import unpack
+from twisted.internet import reactor
+
+from minerutil.Midstate import calculateMidstate
+from minerutil.CPUSearch import searchBatch, workerMain
+from QueueReader import QueueReader
+from KernelInterface import *
+
+def calculateUnitData(unit):
+    """Calculate the midstate, the 3-round state2, and the nonce-independent
+    words of the second block for a WorkUnit.
+    """
+    # The data words of the second SHA-256 block, as SHA-256 sees them.
+    data = unpack('<IIII', unit.data[64:])
+
+    state = unit.precompute('cpu.state',
+        lambda u: unpack('<IIIIIIII', u.midstate), True)
+    state2 = unpack('<IIIIIIII',
+        calculateMidstate(unit.data[64:80] +
+            '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
+            unit.midstate, 3))
+    return state, state2, data[:3]
+
+class KernelData(object):
+    """This class is a container for all the data required for a single kernel
+    execution.
+    """
+
+    def __init__(self, nonceRange, batchSize):
+        self.iterations = max(1, -(-nonceRange.size // batchSize))
+
+        #compute bases and sizes for each iteration
+        self.base = []
+        end = nonceRange.base + nonceRange.size
+        for i in range(self.iterations):
+            start = nonceRange.base + i * batchSize
+            self.base.append((start, min(batchSize, end - start)))
+
+        #the state and precalculated static data depend only on the WorkUnit,
+        #so they are shared by all of its NonceRanges
+        self.state, self.state2, self.w = nonceRange.unit.precompute(
+            'cpu', calculateUnitData)
+        self.nr = nonceRange
+
+class Worker(object):
+    """A single hashing core, with its own CoreInterface and QueueReader so
+    that its rate is reported separately. If a process is used, batches are
+    shipped over a pipe; otherwise they are hashed in the mining thread.
+    """
+
+    def __init__(self, kernel, useProcess):
+        self.core = kernel.interface.addCore()
+        self.qr = QueueReader(self.core, lambda nr: kernel.preprocess(nr))
+        self.process = None
+
+        if useProcess:
+            self.conn, child = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=workerMain,
+                                                   args=(child,))
+            self.process.daemon = True
+
+    def start(self):
+        if self.process is not None:
+            self.process.start()
+        self.qr.start()
+
+    def search(self, *job):
+        if self.process is None:
+            return searchBatch(*job)
+        self.conn.send(job)
+        return self.conn.recv()
+
+    def finish(self):
+        """Called by the mining thread once the QueueReader has stopped."""
+        if self.process is not None:
+            self.conn.send(None)
+
+class MiningKernel(object):
+    """A Phoenix Miner-compatible kernel that hashes on the CPU using NumPy.
+    This is far slower than any of the OpenCL kernels, but needs no OpenCL
+    platform at all.
+    """
+
+    AGGRESSION = KernelOption(
+        'AGGRESSION', int, default=4, advanced=True,
+        help='Exponential factor indicating how many nonces to hash '
+        'per NumPy batch')
+    PROCESSES = KernelOption(
+        'PROCESSES', int, default=None,
+        help='The number of worker processes to hash with '
+        '(defaults to one per CPU core)')
+
+    # This must be manually set for Git
+    REVISION = 1
+
+    def __init__(self, interface):
+        self.interface = interface
+
+        # Each batch is 2^(10 + aggression) nonces.
+        self.AGGRESSION += 10
+        self.AGGRESSION = min(24, self.AGGRESSION)
+        self.AGGRESSION = max(10, self.AGGRESSION)
+        self.batchSize = 1 << self.AGGRESSION
+
+        if self.PROCESSES is None:
+            try:
+                self.PROCESSES = multiprocessing.cpu_count()
+            except NotImplementedError:
+                self.PROCESSES = 1
+        self.PROCESSES = max(1, self.PROCESSES)
+
+        # A single core gains nothing from a separate process, but more than
+        # one can only get past the GIL by hashing in a process each. Every
+        # worker still gets a dedicated mining thread to feed it.
+        self.workers = [Worker(self, self.PROCESSES > 1)
+                        for i in range(self.PROCESSES)]
+
+        self.applyMeta()
+
+    def applyMeta(self):
+        """Apply any kernel-specific metadata."""
+        self.interface.setMeta('kernel', 'cpu r%s' % self.REVISION)
+        self.interface.setMeta('device', platform.processor() or 'CPU')
+        self.interface.setMeta('cores', self.PROCESSES)
+
+    def start(self):
+        """Phoenix wants the kernel to start."""
+
+        # Each mining thread spends its time blocked on a worker, so make sure
+        # they don't crowd out the threads used by the RPC client.
+        reactor.suggestThreadPoolSize(10 + len(self.workers))
+
+        for worker in self.workers:
+            worker.start()
+            reactor.callInThread(self.mineThread, worker)
+
+    def stop(self):
+        """Phoenix wants this kernel to stop. The kernel is not necessarily
+        reusable, so it's safe to clean up as well.
+        """
+        for worker in self.workers:
+            worker.qr.stop()
+
+    def preprocess(self, nr):
+        return KernelData(nr, self.batchSize)
+
+    def postprocess(self, nonces, nr, foundAt):
+        self.interface.verifyNonces(nr, nonces, foundAt)
+
+    def mineThread(self, worker):
+        for data in worker.qr:
+            searched = 0
+            for base, count in data.base:
+                # Give up on the rest of the range if a new block came out.
+                if searched and worker.qr.stale(searched):
+                    break
+                found = worker.search(data.state, data.state2, data.w,
+                                      base, count)
+                if len(found):
+                    reactor.callFromThread(self.postprocess, found, data.nr,
+                                           time())
+                searched += count
+        worker.finish()
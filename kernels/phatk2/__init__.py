@@ -23,61 +23,32 @@
 import pyopencl as cl
 import numpy as np
 import os
-import math
 
-from hashlib import md5
+from time import time
 from struct import pack, unpack
 from twisted.internet import reactor
 
 from minerutil.Midstate import calculateMidstate
-from QueueReader import QueueReader
+from QueueReader import QueueReader, WorkSizeController
 from KernelInterface import *
 from BFIPatcher import *
 
-class KernelData(object):
-    #This class is a container for all the data required for a single kernel execution.
-
-    def __init__(self, nonceRange, core, rateDivisor, aggression):
-        # Prepare some raw data, converting it into the form that the OpenCL
-        # function expects.
-        data   = np.array(
-            unpack('IIII', nonceRange.unit.data[64:]), dtype=np.uint32)
+class UnitData(object):
+    """The part of KernelData that is calculated once per WorkUnit."""
 
-        # get the number of iterations from the aggression and size
-        self.iterations = int(nonceRange.size / (1 << aggression))
-        self.iterations = max(1, self.iterations)
-
-        #set the size to pass to the kernel based on iterations and vectors
-        self.size = (nonceRange.size / rateDivisor) / self.iterations
-        self.totalsize = nonceRange.size
-        #compute bases for each iteration
+    def __init__(self, unit):
+        data = np.array(unpack('IIII', unit.data[64:]), dtype=np.uint32)
 
-        self.base = [None] * self.iterations
-        for i in range(self.iterations):
-            if rateDivisor == 1:
-                self.base[i] = pack('I',
-                    ((nonceRange.base) + (i * self.size * rateDivisor)))
-            if rateDivisor == 2:
-                self.base[i] = pack('II',
-                    ((nonceRange.base) + (i * self.size * rateDivisor))
-                    , (1 + (nonceRange.base) + (i * self.size * rateDivisor)))
-            if rateDivisor == 4:
-                self.base[i] = pack('IIII',
-                    ((nonceRange.base) + (i * self.size * rateDivisor))
-                    , (1 + (nonceRange.base) + (i * self.size * rateDivisor))
-                    , (2 + (nonceRange.base) + (i * self.size * rateDivisor))
-                    , (3 + (nonceRange.base) + (i * self.size * rateDivisor))
-                    )
-        #set up state and precalculated static data
-        self.state  = np.array(
-            unpack('IIIIIIII', nonceRange.unit.midstate), dtype=np.uint32)
+        # The midstate survives ntime rolling, so this part is shared by
+        # every WorkUnit rolled from the same work.
+        self.state = unit.precompute('phatk2.state', lambda u: np.array(
+            unpack('IIIIIIII', u.midstate), dtype=np.uint32), True)
         self.state2 = np.array(unpack('IIIIIIII',
-            calculateMidstate(nonceRange.unit.data[64:80] +
+            calculateMidstate(unit.data[64:80] +
                 '\x00\x00\x00\x80' + '\x00'*40 + '\x80\x02\x00\x00',
-                nonceRange.unit.midstate, 3)), dtype=np.uint32)
+                unit.midstate, 3)), dtype=np.uint32)
         self.state2 = np.array(
             list(self.state2)[3:] + list(self.state2)[:3], dtype=np.uint32)
-        self.nr = nonceRange
 
         self.f = np.zeros(9, np.uint32)
         self.calculateF(data)
@@ -117,6 +88,42 @@ class KernelData(object):
         self.f[8] = np.uint32(data[2] + (rot(W16, 17) ^ rot(W16, 19) ^
             (W16 >> 10)))
 
+class KernelData(object):
+    #This class is a container for all the data required for a single kernel execution.
+
+    def __init__(self, nonceRange, core, rateDivisor, aggression,
+                 granularity):
+        # get the number of iterations from the aggression and size, running
+        # whole work groups each time
+        step = max(granularity, (1 << aggression) // granularity * granularity)
+        self.iterations = max(1, -(-nonceRange.size // step))
+        self.step = step
+
+        #compute bases and sizes (in work items) for each iteration; only the
+        #last range of a WorkUnit can end partway through a work group
+        self.totalsize = nonceRange.size
+        self.base = [None] * self.iterations
+        self.size = [None] * self.iterations
+        end = nonceRange.base + nonceRange.size
+        for i in range(self.iterations):
+            start = nonceRange.base + i * step
+            count = -(-min(step, end - start) // granularity) * granularity
+            self.size[i] = count / rateDivisor
+            if rateDivisor == 1:
+                self.base[i] = pack('I', start)
+            if rateDivisor == 2:
+                self.base[i] = pack('II', start, 1 + start)
+            if rateDivisor == 4:
+                self.base[i] = pack('IIII', start, 1 + start, 2 + start,
+                                    3 + start)
+        #the state and precalculated static data depend only on the WorkUnit,
+        #so they are shared by all of its NonceRanges
+        unitData = nonceRange.unit.precompute('phatk2', UnitData)
+        self.state = unitData.state
+        self.state2 = unitData.state2
+        self.f = unitData.f
+        self.nr = nonceRange
+
 
 class MiningKernel(object):
     #A Phoenix Miner-compatible OpenCL kernel created by Phateus
@@ -160,7 +167,6 @@ class MiningKernel(object):
         self.interface = interface
         self.core = self.interface.addCore()
         self.defines = ''
-        self.loopExponent = 0
 
         # Set the initial number of nonces to run per execution
         # 2^(16 + aggression)
@@ -170,9 +176,12 @@ class MiningKernel(object):
         self.size = 1 << self.AGGRESSION
 
         # We need a QueueReader to efficiently provide our dedicated thread
-        # with work.
+        # with work. Without FASTLOOP, an execution is never more than a
+        # single OpenCL run.
+        self.workSize = WorkSizeController(initial=self.size,
+            maximum=0x100000000 if self.FASTLOOP else self.size)
         self.qr = QueueReader(self.core, lambda nr: self.preprocess(nr),
-                                lambda x,y: self.size * 1 << self.loopExponent)
+                              controller=self.workSize)
 
         # The platform selection must be valid to mine.
         if self.PLATFORM >= len(platforms) or \
@@ -272,6 +281,10 @@ class MiningKernel(object):
         else:
             self.rateDivisor = 1
 
+        # Every execution is a whole number of work groups.
+        self.workSize.setGranularity(self.WORKSIZE * self.rateDivisor,
+                                     self.size)
+
         # Some AMD devices support a special "bitalign" instruction that makes
         # bitwise rotation (required for SHA-256) much faster.
         if (device.extensions.find('cl_amd_media_ops') != -1):
@@ -287,27 +300,27 @@ class MiningKernel(object):
         kernel = kernelFile.read()
         kernelFile.close()
 
-        # For fast startup, we cache the compiled OpenCL code. The name of the
-        # cache is determined as the hash of a few important,
-        # compilation-specific pieces of information.
-        m = md5()
-        m.update(device.platform.name)
-        m.update(device.platform.version)
-        m.update(device.name)
-        m.update(self.defines)
-        m.update(kernel)
-        cacheName = '%s.elf' % m.hexdigest()
-
-        fileName = os.path.join(kernelFileDir, cacheName)
+        # For fast startup, we cache the compiled OpenCL code. The cache key
+        # is determined as the hash of a few important, compilation-specific
+        # pieces of information.
+        cache = self.interface.getKernelCache()
+        cacheKey = cache.makeKey(device.platform.name, device.platform.version,
+                                 device.name, self.defines, kernel)
 
         # Finally, the actual work of loading the kernel...
-        try:
-            binary = open(fileName, 'rb')
-        except IOError:
-            binary = None
+        binaryData = cache.load(cacheKey)
+        if binaryData is not None:
+            try:
+                self.kernel = cl.Program(
+                    self.context, [device], [binaryData]).build(self.defines)
+            except cl.LogicError:
+                self.interface.debug('Cached kernel failed to load, '
+                                     'recompiling')
+                cache.remove(cacheKey)
+                binaryData = None
 
         try:
-            if binary is None:
+            if binaryData is None:
                 self.kernel = cl.Program(
                     self.context, kernel).build(self.defines)
 
@@ -324,14 +337,10 @@ class MiningKernel(object):
                         self.context, [device],
                         [binaryData]).build(self.defines)
 
-                #write the kernel binaries to file
-                binaryW = open(fileName, 'wb')
-                binaryW.write(self.kernel.binaries[0])
-                binaryW.close()
-            else:
-                binaryData = binary.read()
-                self.kernel = cl.Program(
-                    self.context, [device], [binaryData]).build(self.defines)
+                #store the kernel binaries in the cache
+                cache.store(cacheKey, self.kernel.binaries[0],
+                    platform=device.platform.name, device=device.name,
+                    defines=self.defines)
 
         except cl.LogicError:
             self.interface.fatal('Failed to compile OpenCL kernel!')
@@ -340,8 +349,6 @@ class MiningKernel(object):
             self.interface.fatal('Failed to apply BFI_INT patch to kernel! '
                 'Is BFI_INT supported on this hardware?')
             return
-        finally:
-            if binary: binary.close()
 
         #unload the compiler to reduce memory usage
         cl.unload_compiler()
@@ -358,50 +365,31 @@ class MiningKernel(object):
 
         self.qr.stop()
 
-    def updateIterations(self):
-        # Set up the number of internal iterations to run if FASTLOOP enabled
-        rate = self.core.getRate()
-
-        if not (rate <= 0):
-            #calculate the number of iterations to run
-            EXP = max(0, (math.log(rate)/math.log(2)) - (self.AGGRESSION - 8))
-            #prevent switching between loop exponent sizes constantly
-            if EXP > self.loopExponent + 0.54:
-                EXP = round(EXP)
-            elif EXP < self.loopExponent - 0.65:
-                EXP = round(EXP)
-            else:
-                EXP = self.loopExponent
-
-            self.loopExponent = int(max(0, EXP))
-
     def preprocess(self, nr):
-        if self.FASTLOOP:
-            self.updateIterations()
-
-        kd = KernelData(nr, self.core, self.rateDivisor, self.AGGRESSION)
+        kd = KernelData(nr, self.core, self.rateDivisor, self.AGGRESSION,
+                        self.workSize.granularity)
         return kd
 
-    def postprocess(self, output, nr):
+    def postprocess(self, output, nr, foundAt):
         #Scans over a single buffer produced as a result of running the
         #OpenCL kernel on the device. This is done outside of the mining thread
         #for efficiency reasons.
 
-        # Iterate over only the first OUTPUT_SIZE items. Exclude the last item
-        # which is a duplicate of the most recently-found nonce.
-        for i in xrange(self.OUTPUT_SIZE):
-            if output[i]:
-                if not self.interface.foundNonce(nr, int(output[i])):
-                    hash = self.interface.calculateHash(nr, int(output[i]))
-                    if not hash.endswith('\x00\x00\x00\x00'):
-                        self.interface.error('Unusual behavior from OpenCL. '
-                            'Hardware problem?')
+        # Verify only the first OUTPUT_SIZE items. Exclude the last item
+        # which is a duplicate of the most recently-found nonce, and the
+        # empty (zero) slots.
+        output = output[:self.OUTPUT_SIZE]
+        self.interface.verifyNonces(nr, output[output != 0], foundAt)
 
     def mineThread(self):
         for data in self.qr:
             for i in range(data.iterations):
+                # Give up on the rest of the range if a new block came out.
+                if i and self.qr.stale(i * data.step):
+                    break
+
                 self.kernel.search(
-                    self.commandQueue, (data.size, ), (self.WORKSIZE, ),
+                    self.commandQueue, (data.size[i], ), (self.WORKSIZE, ),
                     data.state[0], data.state[1], data.state[2], data.state[3],
                     data.state[4], data.state[5], data.state[6], data.state[7],
                     data.state2[1], data.state2[2], data.state2[3],
@@ -422,7 +410,7 @@ class MiningKernel(object):
                 # for the next pass.
                 if self.output[self.OUTPUT_SIZE]:
                     reactor.callFromThread(self.postprocess,
-                    self.output.copy(), data.nr)
+                    self.output.copy(), data.nr, time())
 
                     self.output.fill(0)
                     cl.enqueue_write_buffer(
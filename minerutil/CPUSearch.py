@@ -0,0 +1,116 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""The CPU kernel's hashing, kept in a module of its own so that worker
+processes can import it by name, even where they're spawned rather than
+forked (e.g. on Windows), which the kernel itself loaded by imp can't be.
+"""
+
+import signal
+import numpy as np
+
+from Midstate import rotateright, K, A0, B0, C0, D0, E0, F0, G0, H0
+
+# The second round of SHA-256 is stopped after 61 rounds: at that point, 'e'
+# already holds what will become the final 'h', so a nonce is only worth
+# reporting if 'e' + H0 == 0, i.e. the last 32 bits of the hash are zero.
+TARGET_E = (-H0) & 0xFFFFFFFF
+
+# The following helpers operate on either plain Python integers or uint32
+# NumPy arrays (holding one value per nonce). Anything that doesn't depend on
+# the nonce stays a Python integer, which means constant subexpressions are
+# folded once per batch rather than being evaluated over the whole array.
+
+def rotr(x, n):
+    if isinstance(x, np.ndarray):
+        return (x >> n) | (x << (32 - n))
+    return rotateright(x, n)
+
+def add(*terms):
+    """Add together any mix of integers and arrays, modulo 2^32."""
+    const = 0
+    array = None
+    for t in terms:
+        if isinstance(t, np.ndarray):
+            array = t if array is None else array + t
+        else:
+            const += t
+    const &= 0xFFFFFFFF
+    if array is None:
+        return const
+    return array + const if const else array
+
+def compress(state, w, start, stop):
+    """Run SHA-256 rounds start..stop-1 on state, using the (16 word) message
+    w. Returns the resulting a, b, c, d, e, f, g, h.
+    """
+    a,b,c,d,e,f,g,h = state
+    w = list(w)
+    for i in range(start, stop):
+        if i >= 16:
+            s0 = rotr(w[i-15], 7) ^ rotr(w[i-15], 18) ^ (w[i-15] >> 3)
+            s1 = rotr(w[i-2], 17) ^ rotr(w[i-2], 19) ^ (w[i-2] >> 10)
+            w.append(add(w[i-16], s0, w[i-7], s1))
+
+        s0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+        s1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+        ma = (a & b) | (c & (a | b))
+        ch = g ^ (e & (f ^ g))
+
+        t1 = add(h, s1, ch, K[i], w[i])
+        t2 = add(s0, ma)
+        a,b,c,d,e,f,g,h = add(t1, t2),a,b,c,add(d, t1),e,f,g
+    return a,b,c,d,e,f,g,h
+
+def searchBatch(midstate, state2, w, base, count):
+    """Double-SHA-256 the nonces base..base+count-1 and return an array of
+    the ones whose hash ends in 32 zero bits.
+
+    midstate is the first-block state, state2 is that state after the 3
+    nonce-independent rounds of the second block, and w is the 3 leading
+    words of the second block. Everything is plain integers, so this can be
+    sent to another process as-is.
+    """
+    nonces = np.arange(count, dtype=np.uint32) + np.uint32(base)
+
+    # The rest of the second block: nonce, padding, and length (640 bits).
+    block = list(w) + [nonces, 0x80000000] + [0]*10 + [640]
+    state = compress(state2, block, 3, 64)
+    hash1 = [add(x, y) for x,y in zip(state, midstate)]
+
+    block = hash1 + [0x80000000] + [0]*6 + [256]
+    state = compress((A0, B0, C0, D0, E0, F0, G0, H0), block, 0, 61)
+    e = state[4]
+
+    return nonces[e == TARGET_E]
+
+def workerMain(conn):
+    """The entry point of a worker process. It receives searchBatch arguments
+    over the pipe and sends back the nonces found, until it receives None.
+    """
+    # Ctrl+C is for the main process to handle.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        conn.send(searchBatch(*job).tolist())
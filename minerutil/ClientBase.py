@@ -20,6 +20,12 @@
 # THE SOFTWARE.
 
 import struct
+from twisted.internet import reactor
+
+class WorkExpired(Exception):
+    """A result was for work that can no longer be submitted (such as work
+    from an earlier session), so it has neither been accepted nor rejected.
+    """
 
 class AssignedWork(object):
     data = None
@@ -28,12 +34,16 @@ class AssignedWork(object):
     maxtime = None
     time = None
     identifier = None
+    midstate = None # Only if the server sent it.
+    pool = None # Set by the PoolManager, if there is one.
     def setMaxTimeIncrement(self, n):
         self.time = n
         self.maxtime = struct.unpack('>I', self.data[68:72])[0] + n
 
 class ClientBase(object):
     callbacksActive = True
+    pending = 0
+    pendingCall = None
 
     def _deactivateCallbacks(self):
         """Shut down the runCallback function. Typically used post-disconnect.
@@ -48,4 +58,24 @@ class ClientBase(object):
 
         func = getattr(self.handler, 'on' + callback.capitalize(), None)
         if callable(func):
-            func(*args)
\ No newline at end of file
+            func(*args)
+
+    def deliverWork(self, count):
+        """Make sure count units of work, built by _makeWork, are on their way
+        to the handler. They're handed over on the next reactor iteration,
+        since the WorkQueue asks for work while storing work.
+        """
+        self.pending = max(self.pending, count)
+        if self.pendingCall is None or not self.pendingCall.active():
+            self.pendingCall = reactor.callLater(0, self._deliver)
+
+    def _deliver(self):
+        # Units stop being on their way one at a time, so that the handler
+        # asking for more while storing one doesn't count the rest twice.
+        while self.pending > 0:
+            aw = self._makeWork()
+            if aw is None:
+                self.pending = 0
+                return
+            self.pending -= 1
+            self.runCallback('work', aw)
\ No newline at end of file
@@ -19,11 +19,30 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from twisted.internet import reactor, defer
+from time import time
+from collections import deque
+from twisted.internet import reactor, defer, error
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import LineReceiver
 
 from ClientBase import *
+from Midstate import calculateMidstates
+
+# The newest version of the protocol this client speaks. Version 2 adds:
+#   (client) META protocol 2     offered after LOGIN; old servers ignore it
+#   (server) PROTO <version>     the version both sides will use
+#   (client) WANT <count>        like MORE, but for count units at once
+#   (server) WORKS <mask> :<unit> <unit> ...
+#                                several units in one line, each the data in
+#                                hex, optionally followed by '/' and the
+#                                midstate of its first 64 bytes in hex; only
+#                                in answer to WANT or MORE, so work the server
+#                                pushes on its own still comes as WORK
+#   (client) RESULTS <id> :<result> <result> ...
+#                                several results in one line, numbered from id
+#   (server) ACKS :<ack> <ack> ...
+#                                +<id> for an accepted result, -<id> rejected
+PROTOCOL_VERSION = 2
 
 class MMPProtocolBase(LineReceiver):
     delimiter = '\r\n'
@@ -87,6 +106,19 @@ class MMPClientProtocol(MMPProtocolBase, ClientBase):
 
     metaSent = False
 
+    # Until the server says otherwise, it only speaks version 1.
+    version = 1
+
+    # When each unit asked for (with WANT or MORE) that hasn't arrived yet
+    # was asked for. Those that take longer than MAX_WAIT are asked for again.
+    wants = None
+    wantCall = None
+    MAX_WAIT = 30
+
+    # Results per RESULTS line, which keeps lines well under the 16KB that
+    # LineReceiver allows.
+    MAX_BATCH = 64
+
     commands = {
         'MSG':      (str,),
         'TARGET':   (str,),
@@ -95,19 +127,32 @@ class MMPClientProtocol(MMPProtocolBase, ClientBase):
         'ACCEPTED': (str,),
         'REJECTED': (str,),
         'TIME':     (int,),
+        'PROTO':    (int,),
+        'WORKS':    (int, str),
+        'ACKS':     (str,),
     }
 
     def connectionMade(self):
         self.factory.connection = self
+        self.wants = deque()
+        self.nextId = 1
+        self.resultIds = {}
+        self.batch = []
+        self.flushCall = None
         self.runCallback('connect')
         self.sendLine('LOGIN %s :%s' % (self.factory.username,
                                         self.factory.password))
+        self.sendMeta('protocol', PROTOCOL_VERSION)
         # Got meta?
         for var,value in self.factory.meta.items():
             self.sendMeta(var, value)
         self.metaSent = True
 
     def connectionLost(self, reason):
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        if self.wantCall is not None and self.wantCall.active():
+            self.wantCall.cancel()
         self.runCallback('disconnect')
         self.factory.connection = None
         self.factory._purgeDeferreds()
@@ -131,11 +176,116 @@ class MMPClientProtocol(MMPProtocolBase, ClientBase):
     def cmd_TIME(self, time):
         self.time = time
 
+    def requestWork(self, count):
+        # As with the other connections, this makes sure count units are on
+        # their way, rather than asking for count more.
+        if self.version >= 2:
+            if count > len(self.wants):
+                self._want(count - len(self.wants))
+        elif not self.wants:
+            self._want(1)
+
+    def _want(self, count):
+        if self.version >= 2:
+            self.sendLine('WANT %d' % count)
+        else:
+            self.sendLine('MORE')
+            count = 1
+        self.wants.extend([time()] * count)
+        self._scheduleExpiry()
+
+    def _scheduleExpiry(self):
+        if self.wants and (self.wantCall is None or
+                           not self.wantCall.active()):
+            wait = self.MAX_WAIT - (time() - self.wants[0])
+            self.wantCall = reactor.callLater(max(0, wait), self._expireWants)
+
+    def _expireWants(self):
+        # Units that never came (a lost reply, or a server that only pushes)
+        # are asked for again, so the connection doesn't wait forever.
+        now = time()
+        expired = 0
+        while self.wants and now - self.wants[0] >= self.MAX_WAIT:
+            self.wants.popleft()
+            expired += 1
+        if expired:
+            self._want(expired)
+        else:
+            self._scheduleExpiry()
+
+    def _answered(self, count):
+        for i in range(min(count, len(self.wants))):
+            self.wants.popleft()
+
+    def sendResult(self, result, urgent):
+        if self.version < 2:
+            self.sendLine('RESULT ' + result.encode('hex'))
+            self.runCallback('sent', result)
+            return
+
+        # Results found together go out together, on the next reactor
+        # iteration; a block goes out right away, along with anything queued.
+        self.batch.append(result)
+        if urgent or len(self.batch) >= self.MAX_BATCH:
+            self.flushResults()
+        elif self.flushCall is None or not self.flushCall.active():
+            self.flushCall = reactor.callLater(0, self.flushResults)
+
+    def flushResults(self):
+        if self.flushCall is not None and self.flushCall.active():
+            self.flushCall.cancel()
+        self.flushCall = None
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        firstId = self.nextId
+        for result in batch:
+            self.resultIds[self.nextId] = result
+            self.nextId += 1
+        self.sendLine('RESULTS %d :%s' % (firstId,
+                      ' '.join(result.encode('hex') for result in batch)))
+        for result in batch:
+            self.runCallback('sent', result)
+
+    def cmd_PROTO(self, version):
+        self.version = min(version, PROTOCOL_VERSION)
+
     def cmd_WORK(self, work, mask):
         try:
             data = work.decode('hex')
         except (ValueError, TypeError):
             return
+        # Version 2 servers answer WANT with WORKS, so this was pushed.
+        if self.version < 2 and len(data) == 80:
+            self._answered(1)
+        self.workReceived(data, mask)
+
+    def cmd_WORKS(self, mask, units):
+        received = []
+        for unit in units.split():
+            work, _, midstate = unit.partition('/')
+            try:
+                data = work.decode('hex')
+                midstate = midstate.decode('hex')
+            except (ValueError, TypeError):
+                continue
+            if len(data) == 80:
+                received.append((data, midstate))
+
+        # Whatever the server left without a midstate is worked out here, all
+        # in one go, rather than unit by unit as the WorkQueue stores them.
+        missing = [i for i, unit in enumerate(received) if len(unit[1]) != 32]
+        if missing:
+            midstates = calculateMidstates([received[i][0][:64]
+                                            for i in missing])
+            for i, midstate in zip(missing, midstates):
+                received[i] = (received[i][0], midstate)
+
+        self._answered(len(received))
+        for data, midstate in received:
+            self.workReceived(data, mask, midstate)
+
+    def workReceived(self, data, mask, midstate=None):
         if len(data) != 80:
             return
         wu = AssignedWork()
@@ -144,6 +294,8 @@ class MMPClientProtocol(MMPProtocolBase, ClientBase):
         wu.target = self.target
         wu.setMaxTimeIncrement(self.time)
         wu.identifier = data[4:36]
+        if midstate and len(midstate) == 32:
+            wu.midstate = midstate
         self.runCallback('work', wu)
         # Since the server is giving work, we know it has accepted our
         # login details, so we can reset the factory's reconnect delay.
@@ -157,6 +309,14 @@ class MMPClientProtocol(MMPProtocolBase, ClientBase):
     def cmd_REJECTED(self, data):
         self.factory._resultReturned(data, False)
 
+    def cmd_ACKS(self, acks):
+        for ack in acks.split():
+            try:
+                result = self.resultIds.pop(int(ack[1:]))
+            except (ValueError, KeyError):
+                continue
+            self.factory._resultDone(result, ack[0] == '+')
+
 class MMPClient(ReconnectingClientFactory, ClientBase):
     """This class implements an outbound connection to an MMP server.
 
@@ -211,13 +371,14 @@ class MMPClient(ReconnectingClientFactory, ClientBase):
 
         self.stopTrying()
 
-    def requestWork(self):
+    def requestWork(self, count=1):
         """If connected, ask the server for more work. The request is not sent
         if the client isn't connected, since the server will provide work upon
-        next login anyway.
+        next login anyway. (Version 1 servers can only be asked for one unit
+        at a time, so count is ignored with those.)
         """
         if self.connection is not None:
-            self.connection.sendLine('MORE')
+            self.connection.requestWork(count)
 
     def setMeta(self, var, value):
         """Set a metavariable, which gets sent to the server on-connect (or
@@ -242,13 +403,15 @@ class MMPClient(ReconnectingClientFactory, ClientBase):
 
         self.setMeta('version', vstr)
 
-    def sendResult(self, result):
+    def sendResult(self, result, urgent=False):
         """Submit a work result to the server. Returns a deferred which
         provides a True/False depending on whether or not the server
-        accepetd the work.
+        accepetd the work. Results are batched if the server allows it, except
+        urgent ones, which are sent immediately. The deferred fails if the
+        result can't be delivered.
         """
         if self.connection is None:
-            return defer.succeed(False)
+            return defer.fail(error.ConnectionLost('Not connected'))
 
         d = defer.Deferred()
 
@@ -257,12 +420,14 @@ class MMPClient(ReconnectingClientFactory, ClientBase):
         else:
             self.deferreds[result] = d
 
-        self.connection.sendLine('RESULT ' + result.encode('hex'))
+        self.connection.sendResult(result, urgent)
         return d
 
     def _purgeDeferreds(self):
+        # The server may never have seen these results, so they haven't been
+        # rejected as such; fail them, so that they can be resent.
         for d in self.deferreds.values():
-            d.callback(False)
+            d.errback(error.ConnectionLost())
         self.deferreds = {}
 
     def _resultReturned(self, data, accepted):
@@ -271,6 +436,9 @@ class MMPClient(ReconnectingClientFactory, ClientBase):
         except (TypeError, ValueError):
             return
 
+        self._resultDone(data, accepted)
+
+    def _resultDone(self, data, accepted):
         if data in self.deferreds:
             self.deferreds[data].callback(accepted)
             del self.deferreds[data]
\ No newline at end of file
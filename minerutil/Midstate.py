@@ -20,6 +20,13 @@
 # THE SOFTWARE.
 
 import struct
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Some SHA-256 constants...
 K = [
@@ -45,6 +52,20 @@ F0 = 0x9b05688c
 G0 = 0x1f83d9ab
 H0 = 0x5be0cd19
 
+MASK = 0xFFFFFFFF
+
+# How many full midstates to remember, keyed on the 64-byte block they were
+# calculated from. Work with a rolled ntime (or simply repeated work) has the
+# same first block, so it never needs its midstate calculated twice.
+CACHE_SIZE = 256
+
+# Below this many uncached blocks, calculateMidstates doesn't bother with
+# NumPy, as setting up the arrays costs more than it saves.
+BATCH_THRESHOLD = 8
+
+_cache = OrderedDict()
+_cacheLock = threading.Lock()
+
 def rotateright(i,p):
     """i>>>p"""
     p &= 0x1F # p mod 32
@@ -53,6 +74,52 @@ def rotateright(i,p):
 def addu32(*i):
     return sum(list(i))&0xFFFFFFFF
 
+def _compress(w, state, rounds):
+    """Run the given number of SHA-256 rounds on state, where w is the list of
+    16 message words. The message schedule is expanded up front, and the
+    rotations are inlined, since this runs for every single getwork.
+    """
+    for i in range(16, rounds):
+        x = w[i-15]
+        y = w[i-2]
+        s0 = ((x >> 7 | x << 25) ^ (x >> 18 | x << 14) ^ (x >> 3)) & MASK
+        s1 = ((y >> 17 | y << 15) ^ (y >> 19 | y << 13) ^ (y >> 10)) & MASK
+        w.append((w[i-16] + s0 + w[i-7] + s1) & MASK)
+
+    a,b,c,d,e,f,g,h = state
+    for i in range(rounds):
+        s1 = ((e >> 6 | e << 26) ^ (e >> 11 | e << 21) ^
+              (e >> 25 | e << 7)) & MASK
+        ch = g ^ (e & (f ^ g))
+        t1 = h + s1 + ch + K[i] + w[i]
+        s0 = ((a >> 2 | a << 30) ^ (a >> 13 | a << 19) ^
+              (a >> 22 | a << 10)) & MASK
+        ma = (a & b) | (c & (a | b))
+        h = g
+        g = f
+        f = e
+        e = (d + t1) & MASK
+        d = c
+        c = b
+        b = a
+        a = (t1 + s0 + ma) & MASK
+
+    return a,b,c,d,e,f,g,h
+
+def _cacheGet(data):
+    with _cacheLock:
+        midstate = _cache.pop(data, None)
+        if midstate is not None:
+            _cache[data] = midstate
+        return midstate
+
+def _cachePut(data, midstate):
+    with _cacheLock:
+        _cache.pop(data, None)
+        _cache[data] = midstate
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(False)
+
 def calculateMidstate(data, state=None, rounds=None):
     """Given a 512-bit (64-byte) block of (little-endian byteswapped) data,
     calculate a Bitcoin-style midstate. (That is, if SHA-256 were little-endian
@@ -61,48 +128,86 @@ def calculateMidstate(data, state=None, rounds=None):
     if len(data) != 64:
         raise ValueError('data must be 64 bytes long')
 
+    full = state is None and rounds is None
+    if full:
+        midstate = _cacheGet(data)
+        if midstate is not None:
+            return midstate
+
     w = list(struct.unpack('<IIIIIIIIIIIIIIII', data))
 
     if state is not None:
         if len(state) != 32:
             raise ValueError('state must be 32 bytes long')
-        a,b,c,d,e,f,g,h = struct.unpack('<IIIIIIII', state)
+        initial = struct.unpack('<IIIIIIII', state)
     else:
-        a = A0
-        b = B0
-        c = C0
-        d = D0
-        e = E0
-        f = F0
-        g = G0
-        h = H0
-
-    consts = K if rounds is None else K[:rounds]
-    for k in consts:
-        s0 = rotateright(a,2) ^ rotateright(a,13) ^ rotateright(a,22)
-        s1 = rotateright(e,6) ^ rotateright(e,11) ^ rotateright(e,25)
-        ma = (a&b) ^ (a&c) ^ (b&c)
-        ch = (e&f) ^ ((~e)&g)
-
-        h = addu32(h,w[0],k,ch,s1)
-        d = addu32(d,h)
-        h = addu32(h,ma,s0)
-
-        a,b,c,d,e,f,g,h = h,a,b,c,d,e,f,g
-
-        s0 = rotateright(w[1],7) ^ rotateright(w[1],18) ^ (w[1] >> 3)
-        s1 = rotateright(w[14],17) ^ rotateright(w[14],19) ^ (w[14] >> 10)
-        w.append(addu32(w[0], s0, w[9], s1))
-        w.pop(0)
+        initial = (A0, B0, C0, D0, E0, F0, G0, H0)
+
+    result = _compress(w, initial, 64 if rounds is None else rounds)
 
     if rounds is None:
-        a = addu32(a, A0)
-        b = addu32(b, B0)
-        c = addu32(c, C0)
-        d = addu32(d, D0)
-        e = addu32(e, E0)
-        f = addu32(f, F0)
-        g = addu32(g, G0)
-        h = addu32(h, H0)
-
-    return struct.pack('<IIIIIIII', a, b, c, d, e, f, g, h)
\ No newline at end of file
+        result = [(x + y) & MASK for x,y in
+                  zip(result, (A0, B0, C0, D0, E0, F0, G0, H0))]
+
+    midstate = struct.pack('<IIIIIIII', *result)
+    if full:
+        _cachePut(data, midstate)
+    return midstate
+
+def _calculateMidstatesNumPy(blocks):
+    """Calculate full midstates for a list of 64-byte blocks all at once, with
+    one NumPy array per SHA-256 variable holding that variable for every block.
+    """
+    w = np.frombuffer(b''.join(blocks), dtype='<u4').reshape(-1, 16)
+    w = [w[:,i].astype(np.uint32) for i in range(16)]
+    rotr = lambda x,n: (x >> n) | (x << (32 - n))
+
+    for i in range(16, 64):
+        x = w[i-15]
+        y = w[i-2]
+        s0 = rotr(x, 7) ^ rotr(x, 18) ^ (x >> 3)
+        s1 = rotr(y, 17) ^ rotr(y, 19) ^ (y >> 10)
+        w.append(w[i-16] + s0 + w[i-7] + s1)
+
+    initial = (A0, B0, C0, D0, E0, F0, G0, H0)
+    a,b,c,d,e,f,g,h = [np.full(len(blocks), v, dtype=np.uint32)
+                       for v in initial]
+    for i in range(64):
+        s1 = rotr(e, 6) ^ rotr(e, 11) ^ rotr(e, 25)
+        ch = g ^ (e & (f ^ g))
+        t1 = h + s1 + ch + w[i] + np.uint32(K[i])
+        s0 = rotr(a, 2) ^ rotr(a, 13) ^ rotr(a, 22)
+        ma = (a & b) | (c & (a | b))
+        a,b,c,d,e,f,g,h = t1 + s0 + ma,a,b,c,d + t1,e,f,g
+
+    result = np.column_stack([v + np.uint32(v0) for v,v0 in
+                              zip((a,b,c,d,e,f,g,h), initial)])
+    result = result.astype('<u4').tobytes()
+    return [result[i*32:(i+1)*32] for i in range(len(blocks))]
+
+def calculateMidstates(blocks):
+    """Like calculateMidstate, but for a whole sequence of 64-byte blocks at
+    once. Returns a list of midstates, in the same order as the blocks.
+
+    Anything not already cached is calculated in a single pass using NumPy,
+    if it's available.
+    """
+    midstates = [None] * len(blocks)
+    missing = []
+    for i,data in enumerate(blocks):
+        if len(data) != 64:
+            raise ValueError('data must be 64 bytes long')
+        midstates[i] = _cacheGet(data)
+        if midstates[i] is None:
+            missing.append(i)
+
+    if np is not None and len(missing) >= BATCH_THRESHOLD:
+        results = _calculateMidstatesNumPy([blocks[i] for i in missing])
+        for i, midstate in zip(missing, results):
+            midstates[i] = midstate
+            _cachePut(blocks[i], midstate)
+    else:
+        for i in missing:
+            midstates[i] = calculateMidstate(blocks[i])
+
+    return midstates
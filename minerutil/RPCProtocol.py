@@ -24,92 +24,261 @@ import json
 import sys
 import httplib
 import socket
+from collections import deque, OrderedDict
+from struct import pack
 from twisted.internet import defer, reactor, error, threads
+from twisted.internet.protocol import Protocol
 from twisted.python import failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implements
+
+# Twisted can only speak TLS with pyOpenSSL, which is optional; https falls
+# back to httplib without it.
+try:
+    from twisted.internet import ssl
+except ImportError:
+    ssl = None
 
 from ClientBase import ClientBase, AssignedWork
+from WorkBuilder import BlockTemplate, addressToScript, swap32
 
 class ServerMessage(Exception): pass
 
+class StringProducer(object):
+    """Supplies the body of a request from a string."""
+    implements(IBodyProducer)
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+class BodyReader(Protocol):
+    """Collects the body of a response, firing finished with it once the
+    whole body has arrived.
+    """
+
+    def __init__(self):
+        self.data = []
+        self.finished = defer.Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self.transport is not None:
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        self.data.append(data)
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone, PotentialDataLoss):
+            self.finished.callback(''.join(self.data))
+        else:
+            self.finished.errback(reason)
+
+class ConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool that turns off Nagle's algorithm on every new
+    connection. Requests are written as headers followed by body, and a
+    getwork round trip shouldn't have to wait for a delayed ACK in between.
+    """
+
+    def _newConnection(self, key, endpoint):
+        d = HTTPConnectionPool._newConnection(self, key, endpoint)
+        def configure(protocol):
+            try:
+                protocol.transport.setTcpNoDelay(True)
+                protocol.transport.setTcpKeepAlive(True)
+            except AttributeError:
+                pass # Not a TCP transport; never mind.
+            return protocol
+        d.addCallback(configure)
+        return d
+
 class HTTPBase(object):
-    connection = None
+    """Makes HTTP requests entirely on the reactor. Connections are kept alive
+    in a pool, so consecutive requests to the same server share a connection.
+
+    Without TLS support in Twisted, https requests are made with httplib in a
+    thread instead, one at a time over a single kept-alive connection.
+    """
+
     timeout = None
-    __lock = None
-    __response = None
-
-    def __makeResponse(self, *args, **kwargs):
-        # This function exists as a workaround: If the connection is closed,
-        # we also want to kill the response to allow the socket to die, but
-        # httplib doesn't keep the response hanging around at all, so we need
-        # to intercept its creation (hence this function) and store it.
-        self.__response = httplib.HTTPResponse(*args, **kwargs)
-        return self.__response
-
-    def doRequest(self, *args):
-        if self.__lock is None:
-            self.__lock = defer.DeferredLock()
-        return self.__lock.run(threads.deferToThread, self._doRequest, *args)
+    agent = None
+    pool = None
+    requests = None
+    connection = None # The httplib connection, for https without ssl.
+    lock = None
+
+    def _getAgent(self):
+        if self.agent is None:
+            self.pool = ConnectionPool(reactor, persistent=True)
+            self.agent = Agent(reactor, connectTimeout=self.timeout,
+                               pool=self.pool)
+            self.requests = set()
+        return self.agent
+
+    def doRequest(self, url, method, path, body, headers):
+        """Make a request, returning a Deferred that fires with a tuple of
+        (headers, data), where headers is a list of (name, value) pairs with
+        the names in lower case.
+        """
+        agent = self._getAgent()
 
-    def closeConnection(self):
-        if self.connection is not None:
-            if self.connection.sock is not None:
-                self.connection.sock._sock.close()
-            try:
-                self.connection.close()
-            except (AttributeError):
-                #This is to fix "'NoneType' object has no attribute 'close'"
-                #Theoretically this shouldn't be possible as we specifically
-                #verify that self.connection isn't NoneType before trying to
-                #call close(). I would add a debug message here, but HTTPBase
-                #isn't passed a reference to the miner. The stack trace causing
-                #this problem originates from the errback on line 138 (ask())
-                #Most likely some sort of threading problem (race condition)
-                pass
+        if ssl is None and (url.scheme or '').lower() == 'https':
+            if self.lock is None:
+                self.lock = defer.DeferredLock()
+            d = self.lock.run(threads.deferToThread, self._doThreadedRequest,
+                              url, method, path, body, headers)
+        else:
+            host = url.hostname
+            if url.port:
+                host += ':%d' % url.port
+            uri = '%s://%s%s' % (url.scheme or 'http', host, path)
+            headers = Headers(dict((k, [v]) for k,v in headers.items()))
+            producer = StringProducer(body) if body is not None else None
+
+            d = defer.maybeDeferred(agent.request, method, uri, headers,
+                                    producer)
+            d.addCallback(self._readResponse)
+
+        self.requests.add(d)
+        if self.timeout:
+            timeoutCall = reactor.callLater(self.timeout, d.cancel)
+        else:
+            timeoutCall = None
+        def finished(result):
+            self.requests.discard(d)
+            if timeoutCall is not None and timeoutCall.active():
+                timeoutCall.cancel()
+            return result
+        d.addBoth(finished)
+        return d
 
-        if self.__response is not None:
-            try:
-                self.__response.close()
-            except (AttributeError):
-                #This was added for the same reason as the above
-                pass
-        self.connection = None
-        self.__response = None
-
-    def _doRequest(self, url, *args):
-        if self.connection is None:
-            connectionClass = (httplib.HTTPSConnection
-                               if url.scheme.lower() == 'https' else
-                               httplib.HTTPConnection)
-            self.connection = connectionClass(url.hostname,
-                                              url.port,
-                                              timeout=self.timeout)
-            # Intercept the creation of the response class (see above)
-            self.connection.response_class = self.__makeResponse
-            self.connection.connect()
-            self.connection.sock.setsockopt(socket.SOL_TCP,
-                                            socket.TCP_NODELAY, 1)
-            self.connection.sock.setsockopt(socket.SOL_SOCKET,
-                                            socket.SO_KEEPALIVE, 1)
+    def _readResponse(self, response):
+        headers = [(name.lower(), values[-1]) for name,values in
+                   response.headers.getAllRawHeaders()]
+        reader = BodyReader()
+        response.deliverBody(reader)
+        reader.finished.addCallback(lambda data: (headers, data))
+        return reader.finished
+
+    def _doThreadedRequest(self, url, method, path, body, headers):
+        # Runs in a thread. The connection is kept in a local, so that
+        # closeConnection can close it from the reactor to abort the request.
+        connection = self.connection
+        if connection is None:
+            connection = httplib.HTTPSConnection(url.hostname, url.port,
+                                                 timeout=self.timeout)
+            connection.connect()
+            connection.sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+            connection.sock.setsockopt(socket.SOL_SOCKET,
+                                       socket.SO_KEEPALIVE, 1)
+            self.connection = connection
         try:
-            self.connection.request(*args)
-            response = self.connection.getresponse()
-            headers = response.getheaders()
-            data = response.read()
-            return (headers, data)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return (response.getheaders(), response.read())
         except (httplib.HTTPException, socket.error):
-            self.closeConnection()
+            connection.close()
+            if self.connection is connection:
+                self.connection = None
             raise
 
-class RPCPoller(HTTPBase):
-    """Polls the root's chosen bitcoind or pool RPC server for work."""
+    def closeConnection(self):
+        """Abort any requests in progress and close all idle connections."""
+        if self.agent is None:
+            return
+        for d in list(self.requests):
+            d.cancel()
+        self.pool.closeCachedConnections()
+        if self.connection is not None:
+            connection, self.connection = self.connection, None
+            connection.close()
+
+class JSONRPCBase(HTTPBase):
+    """Makes JSON-RPC calls to the root's server."""
+
+    @defer.inlineCallbacks
+    def call(self, method, params=[]):
+        """Call the specified remote function."""
+
+        body = json.dumps({'method': method, 'params': params, 'id': 1})
+        path = self.root.url.path or '/'
+        if self.root.url.query:
+            path += '?' + self.root.url.query
+        response = yield self.doRequest(
+            self.root.url,
+            'POST',
+            path,
+            body,
+            {
+                'Authorization': self.root.auth,
+                'User-Agent': self.root.version,
+                'Content-Type': 'application/json',
+                'X-Work-Identifier': '1'
+            })
+
+        (headers, data) = response
+        result = self.parse(data)
+        defer.returnValue((dict(headers), result))
+
+    @classmethod
+    def parse(cls, data):
+        """Attempt to load JSON-RPC data."""
+
+        response = json.loads(data)
+        try:
+            message = response['error']['message']
+        except (KeyError, TypeError):
+            pass
+        else:
+            raise ServerMessage(message)
+
+        return response.get('result')
+
+class RPCPoller(JSONRPCBase):
+    """Polls the root's chosen bitcoind or pool RPC server for work. As many
+    getwork requests as the miner wants (its queue size, at most) may be
+    outstanding at once, each on its own connection, so that an empty queue
+    can be refilled in one round trip. maxAsks, if set, limits them further.
+
+    A failed request only counts as the server failing if none of the others
+    asked for along with it succeeded, or after MAX_FAILURES in a row.
+    """
 
     timeout = 5
+    maxAsks = None
+    MAX_FAILURES = 3
 
     def __init__(self, root):
         self.root = root
         self.askInterval = None
         self.askCall = None
-        self.currentAsk = None
+        self.asks = set()
+        self.connections = 1 # The most asks there have been at once.
+        self.failures = 0 # Failed asks since the last one that succeeded.
+        self.succeeded = False # Whether any outstanding ask has succeeded.
+
+    def _getAgent(self):
+        agent = JSONRPCBase._getAgent(self)
+        self.pool.maxPersistentPerHost = self.connections
+        return agent
 
     def setInterval(self, interval):
         """Change the interval at which to poll the getwork() function."""
@@ -133,74 +302,181 @@ class RPCPoller(HTTPBase):
                 pass
             self.askCall = None
 
-    def ask(self):
-        """Run a getwork request immediately."""
+    def ask(self, count=1):
+        """Make sure count getwork requests are in progress, starting more
+        immediately if necessary.
+        """
 
-        if self.currentAsk and not self.currentAsk.called:
-             return
+        if self.maxAsks:
+            count = min(count, self.maxAsks)
+        if count > self.connections:
+            self.connections = count
+            if self.pool is not None:
+                self.pool.maxPersistentPerHost = count
+        count -= len(self.asks)
+        if count <= 0:
+            return
         self._stopCall()
 
-        self.currentAsk = self.call('getwork')
+        for i in range(count):
+            self._ask()
+
+    def request(self):
+        return self.call('getwork')
+
+    def handle(self, result, headers):
+        self.root.handleWork(result, headers)
+        self.root.handleHeaders(headers)
+
+    def _ask(self):
+        if not self.asks:
+            self.succeeded = False
+        d = self.request()
+        self.asks.add(d)
 
         def errback(failure):
             try:
                 if failure.check(ServerMessage):
                     self.root.runCallback('msg', failure.getErrorMessage())
-                self.root._failure()
+                self.failures += 1
+                if (not self.asks and not self.succeeded) or \
+                    self.failures >= self.MAX_FAILURES:
+                    self.failures = 0
+                    self.root._failure()
             finally:
                 self._startCall()
 
-        self.currentAsk.addErrback(errback)
-
         def callback(x):
             try:
                 try:
                     (headers, result) = x
                 except TypeError:
                     return
-                self.root.handleWork(result, headers)
-                self.root.handleHeaders(headers)
+                self.failures = 0
+                self.succeeded = True
+                self.handle(result, headers)
             finally:
                 self._startCall()
-        self.currentAsk.addCallback(callback)
 
-    @defer.inlineCallbacks
-    def call(self, method, params=[]):
-        """Call the specified remote function."""
+        def finished(x):
+            self.asks.discard(d)
+            return x
 
-        body = json.dumps({'method': method, 'params': params, 'id': 1})
-        path = self.root.url.path or '/'
-        if self.root.url.query:
-            path += '?' + self.root.url.query
-        response = yield self.doRequest(
-            self.root.url,
-            'POST',
-            path,
-            body,
-            {
-                'Authorization': self.root.auth,
-                'User-Agent': self.root.version,
-                'Content-Type': 'application/json',
-                'X-Work-Identifier': '1'
-            })
+        d.addBoth(finished)
+        d.addErrback(errback)
+        d.addCallback(callback)
 
-        (headers, data) = response
-        result = self.parse(data)
-        defer.returnValue((dict(headers), result))
+class ResultSubmitter(JSONRPCBase):
+    """Submits results to the root's server over connections of its own, so
+    a result never waits behind a getwork request (or its timeout). At most
+    maxInFlight submissions are outstanding at once; the rest are queued.
+    """
 
-    @classmethod
-    def parse(cls, data):
-        """Attempt to load JSON-RPC data."""
+    timeout = 10
+    maxInFlight = 2
 
-        response = json.loads(data)
-        try:
-            message = response['error']['message']
-        except (KeyError, TypeError):
-            pass
+    def __init__(self, root):
+        self.root = root
+        self.queue = deque()
+        self.inFlight = 0
+
+    def _getAgent(self):
+        agent = JSONRPCBase._getAgent(self)
+        self.pool.maxPersistentPerHost = self.maxInFlight
+        return agent
+
+    def submit(self, method, params, urgent=False, result=None):
+        """Queue a call submitting a result (getwork or submitblock), returning
+        a Deferred that fires with (headers, result). Urgent results go to the
+        front of the queue. The root's 'sent' callback is run with result once
+        the call actually goes out.
+        """
+        d = defer.Deferred()
+        if urgent:
+            self.queue.appendleft((method, params, result, d))
         else:
-            raise ServerMessage(message)
+            self.queue.append((method, params, result, d))
+        self._next()
+        return d
 
-        return response.get('result')
+    def _next(self):
+        while self.queue and self.inFlight < self.maxInFlight:
+            method, params, result, d = self.queue.popleft()
+            self.inFlight += 1
+            call = self.call(method, params)
+            if result is not None:
+                self.root.runCallback('sent', result)
+            call.addBoth(self._finished)
+            call.chainDeferred(d)
+
+    def _finished(self, x):
+        self.inFlight -= 1
+        reactor.callLater(0, self._next)
+        return x
+
+    def closeConnection(self):
+        """Abort all submissions, including the queued ones."""
+        queue, self.queue = self.queue, deque()
+        for method, params, result, d in queue:
+            d.errback(failure.Failure(defer.CancelledError()))
+        JSONRPCBase.closeConnection(self)
+
+# What getblocktemplate is asked for, in solo mode.
+TEMPLATE_REQUEST = {'rules': ['segwit'], 'capabilities': ['longpoll']}
+
+class TemplatePoller(RPCPoller):
+    """Polls for block templates rather than getwork, in solo mode. A single
+    template is enough to build any amount of work from, so there is never
+    more than one request at a time.
+    """
+
+    maxAsks = 1
+
+    def request(self):
+        return self.call('getblocktemplate', [TEMPLATE_REQUEST])
+
+    def handle(self, result, headers):
+        self.root.handleTemplate(result)
+
+class TemplateLongPoller(JSONRPCBase):
+    """Waits for the server to change its block template, using
+    getblocktemplate's own long polling.
+    """
+
+    timeout = 3600
+    retryDelay = 15
+
+    def __init__(self, root, longpollid):
+        self.root = root
+        self.longpollid = longpollid
+        self.polling = True
+
+    def start(self):
+        self._request()
+
+    def stop(self):
+        self.polling = False
+        self.closeConnection()
+
+    def _request(self):
+        if not self.polling:
+            return
+        params = dict(TEMPLATE_REQUEST, longpollid=self.longpollid)
+        d = self.call('getblocktemplate', [params])
+        d.addCallbacks(self._received, self._failed)
+
+    def _received(self, x):
+        if not self.polling:
+            return
+        (headers, template) = x
+        if template:
+            self.longpollid = template.get('longpollid', self.longpollid)
+            self.root.handleTemplate(template, True)
+        self._request()
+
+    def _failed(self, failure):
+        if self.polling:
+            reactor.callLater(self.retryDelay, self._request)
 
 class LongPoller(HTTPBase):
     """Polls a long poll URL, reporting any parsed work results to the
@@ -274,7 +550,7 @@ class LongPoller(HTTPBase):
         finally:
             self._request()
 
-        self.root.handleWork(result, headers, True)
+        self.root.handleWork(result, dict(headers), True)
 
 class RPCClient(ClientBase):
     """The actual root of the whole RPC client system."""
@@ -291,12 +567,26 @@ class RPCClient(ClientBase):
             url.username, url.password)).encode('base64').strip()
         self.version = 'RPCClient/2.0'
 
-        self.poller = RPCPoller(self)
+        # In solo mode, work is built locally from getblocktemplate.
+        self.solo = (self.params.get('mode') == 'gbt')
+        if self.solo:
+            if 'address' not in self.params:
+                raise ValueError('Solo mining (mode=gbt) needs an address')
+            self.payoutScript = addressToScript(self.params['address'])
+            self.poller = TemplatePoller(self)
+        else:
+            self.poller = RPCPoller(self)
+        self.template = None
+        self.extranonce = 0
+        self.built = OrderedDict()
+
+        self.submitter = ResultSubmitter(self)
         self.longPoller = None # Gets created later...
         self.disconnected = False
         self.saidConnected = False
         self.block = None
         self.setupMaxtime()
+        self.setupMaxAsks()
 
     def connect(self):
         """Begin communicating with the server..."""
@@ -312,6 +602,7 @@ class RPCClient(ClientBase):
         self.disconnected = True
         self.poller.setInterval(None)
         self.poller.closeConnection()
+        self.submitter.closeConnection()
         if self.longPoller:
             self.longPoller.stop()
             self.longPoller = None
@@ -326,6 +617,16 @@ class RPCClient(ClientBase):
         except (KeyError, ValueError):
             self.maxtime = 60
 
+    def setupMaxAsks(self):
+        # The asks parameter limits how many getwork requests are made at
+        # once, for servers that don't like too many connections.
+        if self.solo:
+            return
+        try:
+            self.poller.maxAsks = max(1, int(self.params['asks']))
+        except (KeyError, ValueError):
+            pass
+
     def setMeta(self, var, value):
         """RPC clients do not support meta. Ignore."""
 
@@ -335,22 +636,39 @@ class RPCClient(ClientBase):
         else:
             self.version = shortname
 
-    def requestWork(self):
-        """Application needs work right now. Ask immediately."""
-        self.poller.ask()
+    def requestWork(self, count=1):
+        """Application needs count more units of work right now. Ask for them
+        all at once (or in solo mode, build them).
+        """
+        if not self.solo:
+            self.poller.ask(count)
+        elif self.template is None:
+            self.poller.ask()
+        else:
+            self.deliverWork(count)
 
-    def sendResult(self, result):
+    def sendResult(self, result, urgent=False):
         """Sends a result to the server, returning a Deferred that fires with
-        a bool to indicate whether or not the work was accepted.
+        a bool to indicate whether or not the work was accepted. Urgent results
+        (blocks) are sent ahead of any others waiting to go out. The Deferred
+        fails if the result may not have reached the server.
         """
 
+        if self.solo:
+            return self._submitBlock(result)
+
         # Must be a 128-byte response, but the last 48 are typically ignored.
-        result += '\x00'*48
+        data = result + '\x00'*48
 
-        d = self.poller.call('getwork', [result.encode('hex')])
+        d = self.submitter.submit('getwork', [data.encode('hex')], urgent,
+                                  result)
 
-        def errback(*ignored):
-            return False # ANY error while turning in work is a Bad Thing(TM).
+        def errback(failure):
+            # An error message means the server saw the result and refused it.
+            # Anything else (timeouts, lost connections...) is passed on.
+            if failure.check(ServerMessage):
+                return False
+            return failure
 
         #we need to return the result, not the headers
         def callback(x):
@@ -366,8 +684,7 @@ class RPCClient(ClientBase):
 
             return accepted
 
-        d.addErrback(errback)
-        d.addCallback(callback)
+        d.addCallbacks(callback, errback)
         return d
 
     #if the server sends a reason for reject then print that
@@ -404,7 +721,8 @@ class RPCClient(ClientBase):
             else:
                 if rollntime.lower() in ('t', 'true', 'on', '1', 'y', 'yes'):
                     maxtime = self.maxtime
-                elif rollntime.lower() in ('f', 'false', 'off', '0', 'n', 'no'):
+                elif rollntime.lower() in ('f', 'false', 'off', '0', 'n',
+                                           'no'):
                     maxtime = 0
                 else:
                     try:
@@ -432,6 +750,82 @@ class RPCClient(ClientBase):
             self.runCallback('push', aw)
         self.runCallback('work', aw)
 
+    def handleTemplate(self, template, pushed=False):
+        if template is None:
+            return
+
+        try:
+            template = BlockTemplate(template, self.payoutScript)
+        except (KeyError, ValueError, TypeError, AttributeError):
+            self.runCallback('msg', 'Server sent an unusable block template')
+            return
+
+        if not self.saidConnected:
+            self.saidConnected = True
+            self.runCallback('connect')
+            self.useAskrate('askrate')
+
+        newBlock = (self.template is None or
+                    template.prevBlock != self.template.prevBlock)
+        self.template = template
+
+        if template.longpollid is not None and not self.longPoller:
+            self.longPoller = TemplateLongPoller(self, template.longpollid)
+            self.longPoller.start()
+            self.runCallback('longpoll', True)
+
+        if self.block != template.height:
+            self.block = template.height
+            self.runCallback('block', template.height)
+
+        # A new template for the same block only adds transactions, so work
+        # that's already queued is still good.
+        if newBlock:
+            aw = self._makeWork()
+            if pushed:
+                self.runCallback('push', aw)
+            self.runCallback('work', aw)
+
+    def _makeWork(self):
+        self.extranonce += 1
+        data, coinbase = self.template.makeData(pack('<Q', self.extranonce))
+
+        aw = AssignedWork()
+        aw.data = data
+        aw.target = self.template.target
+        aw.mask = 32
+        aw.setMaxTimeIncrement(self.maxtime if 'time' in
+                               self.template.mutable else 0)
+        aw.identifier = data[4:36]
+
+        self.built[data[36:68]] = (self.template, coinbase)
+        while len(self.built) > 1024:
+            self.built.popitem(False)
+        return aw
+
+    def _submitBlock(self, result):
+        try:
+            template, coinbase = self.built[result[36:68]]
+        except KeyError:
+            return defer.succeed(False) # Not our work (any more).
+
+        block = template.makeBlock(swap32(result[:80]), coinbase)
+        d = self.submitter.submit('submitblock', [block.encode('hex')], True,
+                                  result)
+
+        def callback(x):
+            (headers, reason) = x
+            # submitblock returns nothing at all if it took the block.
+            if reason is not None:
+                self.runCallback('debug', 'Reject reason: ' + str(reason))
+            return reason is None
+        def errback(failure):
+            if failure.check(ServerMessage):
+                return False
+            return failure
+        d.addCallbacks(callback, errback)
+        return d
+
     def handleHeaders(self, headers):
         try:
             block = int(headers['x-blocknum'])
@@ -0,0 +1,316 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import json
+from collections import OrderedDict
+from struct import pack, unpack
+from twisted.internet import reactor, defer, error
+from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.protocols.basic import LineReceiver
+
+from ClientBase import *
+from WorkBuilder import swap32, merkleRoot, buildHeader, difficultyToTarget, \
+                        coinbaseHeight
+
+class StratumJob(object):
+    """A mining.notify job, from which any number of work units can be built
+    by varying extranonce2.
+    """
+
+    def __init__(self, params):
+        (self.id, prevHash, coinb1, coinb2, branch, version, bits, ntime,
+         self.clean) = params[:9]
+        # The previous block hash is sent word-swapped, the rest big-endian.
+        self.prevBlock = swap32(prevHash.decode('hex'))
+        self.coinb1 = coinb1.decode('hex')
+        self.coinb2 = coinb2.decode('hex')
+        self.branch = [h.decode('hex') for h in branch]
+        self.version = int(version, 16)
+        self.bits = int(bits, 16)
+        self.ntime = int(ntime, 16)
+
+    def makeData(self, extranonce1, extranonce2):
+        """Build the work data for one value of extranonce2."""
+        coinbase = self.coinb1 + extranonce1 + extranonce2 + self.coinb2
+        root = merkleRoot(coinbase, self.branch)
+        return swap32(buildHeader(self.version, self.prevBlock, root,
+                                  self.ntime, self.bits))
+
+class StratumClientProtocol(LineReceiver, ClientBase):
+    """The actual connection to a Stratum server. Use StratumClient instead of
+    using this directly.
+    """
+
+    delimiter = '\n'
+
+    def connectionMade(self):
+        self.factory.connection = self
+        self.nextId = 1
+        self.calls = {}
+        self.subscribed = False
+        self.call('mining.subscribe', [self.factory.version]).addCallbacks(
+            self._subscribed, self._failed)
+        self.call('mining.authorize', [self.factory.username,
+                                       self.factory.password]).addCallbacks(
+            self._authorized, self._failed)
+
+    def connectionLost(self, reason):
+        if self.subscribed:
+            self.runCallback('disconnect')
+        self.factory.connection = None
+        self.factory._connectionLost()
+        calls, self.calls = self.calls, {}
+        for d in calls.values():
+            d.errback(error.ConnectionLost())
+
+    def call(self, method, params):
+        """Send a request, returning a Deferred for its result."""
+        id = self.nextId
+        self.nextId += 1
+        d = self.calls[id] = defer.Deferred()
+        self.sendLine(json.dumps({'id': id, 'method': method,
+                                  'params': params}))
+        return d
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if not isinstance(message, dict):
+            return
+
+        if message.get('method') is not None:
+            self.handleCall(message.get('id'), message['method'],
+                            message.get('params') or [])
+        elif message.get('id') in self.calls:
+            d = self.calls.pop(message['id'])
+            if message.get('error'):
+                d.errback(StratumError(message['error']))
+            else:
+                d.callback(message.get('result'))
+
+    def handleCall(self, id, method, params):
+        function = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+        try:
+            result = function(*params) if function is not None else None
+        except (TypeError, ValueError, IndexError, AttributeError):
+            result = None
+        if id is not None:
+            self.sendLine(json.dumps({'id': id, 'result': result,
+                                      'error': None}))
+
+    def _subscribed(self, result):
+        extranonce1, size = result[1:3]
+        self.factory.setExtranonce(extranonce1.decode('hex'), int(size))
+        self.subscribed = True
+        self.runCallback('connect')
+        self.factory.resetDelay()
+
+    def _authorized(self, result):
+        if not result:
+            self.runCallback('msg', 'Worker authorization failed')
+
+    def _failed(self, failure):
+        if failure.check(error.ConnectionLost):
+            return
+        self.runCallback('msg', failure.getErrorMessage())
+
+    def rpc_mining_notify(self, *params):
+        self.factory.setJob(StratumJob(params))
+
+    def rpc_mining_set_difficulty(self, difficulty):
+        self.factory.setDifficulty(float(difficulty))
+
+    def rpc_client_show_message(self, message):
+        self.runCallback('msg', message)
+
+    def rpc_client_get_version(self):
+        return self.factory.version
+
+class StratumError(Exception):
+    """An error returned by the server, usually as [code, message, data]."""
+
+    def __init__(self, error):
+        if isinstance(error, list) and len(error) >= 2:
+            error = error[1]
+        Exception.__init__(self, str(error))
+
+class StratumClient(ReconnectingClientFactory, ClientBase):
+    """This class implements an outbound connection to a Stratum server.
+
+    Instead of fetching each unit of work from the server, it builds work
+    units itself from the current job, by incrementing extranonce2. Submitted
+    results are matched back to the job and extranonce2 they were built from
+    by their merkle root.
+    """
+
+    protocol = StratumClientProtocol
+    maxDelay = 60
+    initialDelay = 0.2
+
+    # How many built work units to remember, so results can be submitted.
+    MAX_BUILT = 1024
+
+    connection = None
+
+    def __init__(self, handler, host, port, username, password):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.version = 'StratumClient'
+        self.job = None
+        self.epoch = 0
+        self.extranonce1 = ''
+        self.extranonce2Size = 4
+        self.extranonce2 = 0
+        self.target = difficultyToTarget(1)
+        self.built = OrderedDict()
+        self.session = 0
+        self.nextTarget = None
+
+    def buildProtocol(self, addr):
+        p = self.protocol()
+        p.factory = self
+        p.handler = self.handler
+        return p
+
+    def clientConnectionFailed(self, connector, reason):
+        self.runCallback('failure')
+
+        return ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def connect(self):
+        """Tells the StratumClient to connect if it hasn't already."""
+
+        reactor.connectTCP(self.host, self.port, self)
+
+    def disconnect(self):
+        """Tells the StratumClient to disconnect or stop connecting.
+        The StratumClient shouldn't be used again.
+        """
+
+        self._deactivateCallbacks()
+
+        if self.connection is not None:
+            self.connection.transport.loseConnection()
+
+        self.stopTrying()
+
+    def setMeta(self, var, value):
+        """Stratum has no meta. Ignore."""
+
+    def setVersion(self, shortname, longname=None, version=None, author=None):
+        if version is not None:
+            self.version = '%s/%s' % (shortname, version)
+        else:
+            self.version = shortname
+
+    def _connectionLost(self):
+        # Work built from the old session can't be submitted on a new one.
+        # The first job of the next session counts as a new block, so the
+        # WorkQueue drops whatever is still queued from this one.
+        self.job = None
+        self.session += 1
+
+    def setExtranonce(self, extranonce1, size):
+        self.extranonce1 = extranonce1
+        self.extranonce2Size = size
+        self.extranonce2 = 0
+
+    def setDifficulty(self, difficulty):
+        # Takes effect on the next job, as with other Stratum miners.
+        self.nextTarget = difficultyToTarget(difficulty)
+
+    def setJob(self, job):
+        newBlock = (self.job is None or job.clean or
+                    job.prevBlock != self.job.prevBlock)
+        self.job = job
+        if self.nextTarget is not None:
+            self.target, self.nextTarget = self.nextTarget, None
+        if newBlock:
+            # The WorkQueue treats a new identifier as a new block, dropping
+            # everything it has queued, and asks for more from the new job.
+            self.epoch += 1
+            height = coinbaseHeight(job.coinb1)
+            if height is not None:
+                self.runCallback('block', height)
+            self.runCallback('work', self._makeWork())
+
+    def requestWork(self, count=1):
+        """Build count units of work from the current job."""
+        self.deliverWork(count)
+
+    def _makeWork(self):
+        if self.job is None:
+            return None
+
+        limit = 1 << (8 * self.extranonce2Size)
+        extranonce2 = pack('>Q', self.extranonce2 % limit)[8 -
+                           self.extranonce2Size:]
+        self.extranonce2 += 1
+
+        aw = AssignedWork()
+        aw.data = self.job.makeData(self.extranonce1, extranonce2)
+        aw.target = self.target
+        aw.mask = 32
+        # New work costs nothing, so don't bother rolling ntime.
+        aw.setMaxTimeIncrement(0)
+        aw.identifier = aw.data[4:36] + pack('<I', self.epoch)
+
+        self.built[aw.data[36:68]] = (self.session, self.job.id, extranonce2)
+        while len(self.built) > self.MAX_BUILT:
+            self.built.popitem(False)
+        return aw
+
+    def sendResult(self, result, urgent=False):
+        """Submit a work result to the server. Returns a deferred which fires
+        with whether or not the server accepted it, or fails if the result
+        can't be delivered.
+        """
+        if self.connection is None:
+            return defer.fail(error.ConnectionLost('Not connected'))
+
+        try:
+            session, jobId, extranonce2 = self.built[result[36:68]]
+        except KeyError:
+            return defer.succeed(False) # Not our work (any more).
+        if session != self.session:
+            return defer.fail(WorkExpired('Work from an earlier session'))
+
+        ntime, = unpack('>I', result[68:72])
+        nonce, = unpack('>I', result[76:80])
+        d = self.connection.call('mining.submit', [self.username, jobId,
+                                 extranonce2.encode('hex'), '%08x' % ntime,
+                                 '%08x' % nonce])
+        self.runCallback('sent', result)
+
+        def errback(failure):
+            if failure.check(StratumError):
+                self.runCallback('debug', 'Reject reason: ' +
+                                 failure.getErrorMessage())
+                return False
+            return failure
+        d.addCallbacks(bool, errback)
+        return d
@@ -0,0 +1,261 @@
+# Copyright (C) 2011 by jedi95 <jedi95@gmail.com> and
+#                       CFSworks <CFSworks@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""Helpers for building work locally, from a coinbase transaction and the
+merkle branch linking it to the block header, rather than being handed each
+header by the server.
+"""
+
+from struct import pack
+from hashlib import sha256
+
+def swap32(data):
+    """Byteswap every 32-bit word of data. This converts between a block
+    header and the data format used everywhere else in Phoenix.
+    """
+    return ''.join(data[i:i+4][::-1] for i in xrange(0, len(data), 4))
+
+def doubleSHA(data):
+    return sha256(sha256(data).digest()).digest()
+
+def merkleRoot(coinbase, branch):
+    """Calculate the merkle root of a block whose coinbase transaction is
+    coinbase, given the branch of hashes from the coinbase up to the root.
+    """
+    root = doubleSHA(coinbase)
+    for h in branch:
+        root = doubleSHA(root + h)
+    return root
+
+def buildHeader(version, prevBlock, merkleRoot, ntime, bits, nonce=0):
+    """Assemble an 80-byte block header. prevBlock and merkleRoot are in
+    header byte order.
+    """
+    return (pack('<I', version) + prevBlock + merkleRoot +
+            pack('<III', ntime, bits, nonce))
+
+def difficultyToTarget(difficulty):
+    """Convert a (pool) share difficulty into a 32-byte little-endian target.
+    Difficulty 1 is the traditional target of 4 zero bytes.
+    """
+    if difficulty <= 1:
+        return ('\xff'*28) + ('\x00'*4)
+    target = int((0xFFFF << 208) / float(difficulty))
+    return ('%064x' % target).decode('hex')[::-1]
+
+def coinbaseHeight(coinbase):
+    """Read the block height from the start of a coinbase transaction's input
+    script (as required by BIP 34), or return None if it isn't there.
+    """
+    # version (4), input count (1), previous output (36), script length (1)
+    try:
+        n = ord(coinbase[42])
+    except IndexError:
+        return None
+    if not 1 <= n <= 8 or len(coinbase) < 43 + n:
+        return None
+    return int(coinbase[43:43+n][::-1].encode('hex'), 16)
+
+def varint(n):
+    """Encode n as a Bitcoin variable-length integer."""
+    if n < 0xfd:
+        return chr(n)
+    elif n <= 0xffff:
+        return '\xfd' + pack('<H', n)
+    elif n <= 0xffffffff:
+        return '\xfe' + pack('<I', n)
+    else:
+        return '\xff' + pack('<Q', n)
+
+def pushNumber(n):
+    """A script fragment pushing the number n, encoded the way Bitcoin Core
+    does it (which matters for the block height in a coinbase).
+    """
+    if n == 0:
+        return '\x00'
+    if 1 <= n <= 16:
+        return chr(0x50 + n) # OP_1 to OP_16
+    data = ''
+    while n:
+        data += chr(n & 0xff)
+        n >>= 8
+    if ord(data[-1]) & 0x80:
+        data += '\x00'
+    return chr(len(data)) + data
+
+def merkleBranch(hashes):
+    """Given the (internal byte order) hashes of every transaction but the
+    coinbase, return the merkle branch from the coinbase up to the root.
+    """
+    branch = []
+    level = [None] + list(hashes)
+    while len(level) > 1:
+        branch.append(level[1])
+        if len(level) % 2:
+            level.append(level[-1])
+        level = [None] + [doubleSHA(level[i] + level[i+1])
+                          for i in xrange(2, len(level), 2)]
+    return branch
+
+BASE58 = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+BECH32_GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd,
+                    0x2a1462b3]
+
+def _decodeBase58Check(address):
+    n = 0
+    for c in address:
+        n = n * 58 + BASE58.index(c)
+    data = '%x' % n
+    data = ('0' * (len(data) % 2) + data).decode('hex') if n else ''
+    data = '\x00' * (len(address) - len(address.lstrip('1'))) + data
+    if len(data) < 5 or doubleSHA(data[:-4])[:4] != data[-4:]:
+        raise ValueError('bad checksum')
+    return data[:-4]
+
+def _bech32Polymod(values):
+    chk = 1
+    for v in values:
+        b = chk >> 25
+        chk = ((chk & 0x1ffffff) << 5) ^ v
+        for i in range(5):
+            if (b >> i) & 1:
+                chk ^= BECH32_GENERATOR[i]
+    return chk
+
+def _decodeSegwit(address):
+    address = address.lower()
+    pos = address.rfind('1')
+    hrp = address[:pos]
+    data = [BECH32.index(c) for c in address[pos+1:]]
+    if len(data) < 7:
+        raise ValueError('too short')
+
+    # Version 0 uses bech32, later versions use bech32m.
+    version = data[0]
+    check = _bech32Polymod([ord(x) >> 5 for x in hrp] + [0] +
+                           [ord(x) & 31 for x in hrp] + data)
+    if check != (1 if version == 0 else 0x2bc830a3):
+        raise ValueError('bad checksum')
+
+    acc = bits = 0
+    program = ''
+    for v in data[1:-6]:
+        acc = (acc << 5) | v
+        bits += 5
+        while bits >= 8:
+            bits -= 8
+            program += chr((acc >> bits) & 0xff)
+    if bits >= 5 or (acc << (8 - bits)) & 0xff or \
+        not 2 <= len(program) <= 40 or version > 16:
+        raise ValueError('bad witness program')
+    return version, program
+
+def addressToScript(address):
+    """Return the output script paying to a Bitcoin address (P2PKH, P2SH or
+    segwit, on any network). Raises ValueError for anything else.
+    """
+    try:
+        if address.lower().startswith(('bc1', 'tb1', 'bcrt1')):
+            version, program = _decodeSegwit(address)
+            return (chr(0x50 + version) if version else '\x00') + \
+                   chr(len(program)) + program
+
+        payload = _decodeBase58Check(address)
+    except ValueError, e:
+        raise ValueError('Invalid address %s: %s' % (address, e))
+
+    version, h = ord(payload[0]), payload[1:]
+    if len(h) == 20 and version in (0x00, 0x6f):
+        return '\x76\xa9\x14' + h + '\x88\xac'
+    elif len(h) == 20 and version in (0x05, 0xc4):
+        return '\xa9\x14' + h + '\x87'
+    raise ValueError('Unsupported address: %s' % address)
+
+class BlockTemplate(object):
+    """A getblocktemplate result, from which work paying to payoutScript can
+    be built for any extranonce, and a block assembled once it's solved.
+    """
+
+    TAG = '/Phoenix/'
+
+    def __init__(self, template, payoutScript):
+        self.height = int(template['height'])
+        self.version = int(template['version'])
+        self.prevBlock = template['previousblockhash'].decode('hex')[::-1]
+        self.bits = int(template['bits'], 16)
+        self.ntime = int(template['curtime'])
+        self.target = template['target'].decode('hex')[::-1]
+        self.value = int(template['coinbasevalue'])
+        self.mutable = template.get('mutable', [])
+        self.longpollid = template.get('longpollid')
+
+        transactions = template.get('transactions', [])
+        self.transactions = ''.join(tx['data'].decode('hex')
+                                    for tx in transactions)
+        self.count = 1 + len(transactions)
+        self.branch = merkleBranch([(tx.get('txid') or tx['hash'])
+                                    .decode('hex')[::-1]
+                                    for tx in transactions])
+
+        commitment = template.get('default_witness_commitment')
+        self.witnessCommitment = commitment.decode('hex') if commitment \
+                                 else None
+        self.payoutScript = payoutScript
+
+    def makeCoinbase(self, extranonce):
+        """Return the coinbase transaction for extranonce, as it goes in the
+        block, and as it is hashed for its txid.
+        """
+        script = (pushNumber(self.height) + chr(len(extranonce)) +
+                  extranonce + chr(len(self.TAG)) + self.TAG)
+        inputs = ('\x01' + '\x00'*32 + '\xff'*4 + varint(len(script)) +
+                  script + '\xff'*4)
+
+        outputs = [(self.value, self.payoutScript)]
+        if self.witnessCommitment is not None:
+            outputs.append((0, self.witnessCommitment))
+        outputs = varint(len(outputs)) + ''.join(pack('<Q', value) +
+                  varint(len(s)) + s for value,s in outputs)
+
+        stripped = pack('<I', 1) + inputs + outputs + '\x00'*4
+        if self.witnessCommitment is None:
+            return stripped, stripped
+
+        # With a witness commitment, the coinbase must have a witness too: a
+        # single 32-byte reserved value.
+        full = (pack('<I', 1) + '\x00\x01' + inputs + outputs + '\x01\x20' +
+                '\x00'*32 + '\x00'*4)
+        return full, stripped
+
+    def makeData(self, extranonce):
+        """Build the work data for one extranonce. Returns the data and the
+        coinbase transaction to put in the block if it's solved.
+        """
+        coinbase, stripped = self.makeCoinbase(extranonce)
+        root = merkleRoot(stripped, self.branch)
+        header = buildHeader(self.version, self.prevBlock, root,
+                             self.ntime, self.bits)
+        return swap32(header), coinbase
+
+    def makeBlock(self, header, coinbase):
+        """Assemble the full block for a solved header."""
+        return header + varint(self.count) + coinbase + self.transactions
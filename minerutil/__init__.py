@@ -23,6 +23,7 @@ import urlparse
 
 from MMPProtocol import MMPClient
 from RPCProtocol import RPCClient
+from StratumProtocol import StratumClient
 
 def openURL(url, handler):
     """Parses a URL and opens a connection using the appropriate client."""
@@ -39,5 +40,9 @@ def openURL(url, handler):
         return client
     elif parsed.scheme.lower() in ['http', 'https']:
         return RPCClient(handler, parsed)
+    elif parsed.scheme.lower() == 'stratum+tcp':
+        return StratumClient(handler, parsed.hostname or 'localhost',
+            parsed.port or 3333, parsed.username or 'default',
+            parsed.password or 'default')
     else:
         raise ValueError('Unknown protocol: ' + parsed.scheme)
@@ -30,6 +30,9 @@ import minerutil
 from ConsoleLogger import ConsoleLogger
 from WorkQueue import WorkQueue
 from Miner import Miner
+from Benchmark import Benchmark, SyntheticClient
+from ShareJournal import ShareJournal
+from PoolManager import PoolManager
 
 class CommandLineOptions(object):
     """Implements the Options interface for user-specified command-line
@@ -40,6 +43,7 @@ class CommandLineOptions(object):
         self.parsedSettings = None
         self.url = None
         self.url2 = None
+        self.pools = []
         self.logger = None
         self.kernel = None
         self.queue = None
@@ -56,29 +60,92 @@ class CommandLineOptions(object):
             help="the URL of the mining server to work for [REQUIRED]")
         parser.add_option("-b", "--backupurl", dest="url2", default=None,
             help="the URL of the backup mining server to work for if the "
-            "primary is down [OPTIONAL]")
+            "primary is down or unhealthy. It is kept connected, so the "
+            "switch is instant [OPTIONAL]")
+        parser.add_option("-p", "--pool", action="append", dest="pools",
+            default=[], metavar="URL[#WEIGHT]",
+            help="also mine for this pool at the same time; may be given "
+            "more than once. The hashrate is split between the pools by "
+            "weight (1 by default, as for -u). A weight of 0 makes the pool "
+            "a backup, like -b")
         parser.add_option("-q", "--queuesize", dest="queuesize", type="int",
             default=1, help="how many work units to keep queued at all times")
+        parser.add_option("--fetchmargin", dest="fetchmargin", type="float",
+            default=1.0, help="how many seconds early (beyond the expected "
+            "round trip) to ask the server for work before the queue runs "
+            "out")
+        parser.add_option("--prefetch", dest="prefetch", type="int",
+            default=2, help="how many nonce ranges each mining thread keeps "
+            "ready ahead of the one it's running")
+        parser.add_option("--latency", dest="latency", type="int",
+            default=100, help="how long, in milliseconds, each kernel "
+            "execution should take")
         parser.add_option("-a", "--avgsamples", dest="avgsamples", type="int",
             default=10,
             help="how many samples to use for hashrate average")
+        parser.add_option("-c", "--cachedir", dest="cachedir", default=None,
+            help="the directory to cache compiled kernels in")
+        parser.add_option("--cachesize", dest="cachesize", type="int",
+            default=64, help="how many MB of compiled kernels to keep cached")
+        parser.add_option("-j", "--journal", dest="journal", default=None,
+            help="keep found shares in this file until the server has "
+            "answered for them, resubmitting them if necessary")
+        parser.add_option("--benchmark", action="store_true",
+            dest="benchmark", default=False,
+            help="mine synthetic work without a server, and report how "
+            "the miner performed")
+        parser.add_option("--benchtime", dest="benchtime", type="int",
+            default=60, help="how many seconds to run the benchmark for")
 
         self.parsedSettings, args = parser.parse_args()
 
-        if self.parsedSettings.url is None:
+        if self.parsedSettings.url is None and \
+            not self.parsedSettings.pools and \
+            not self.parsedSettings.benchmark:
             parser.print_usage()
             exit()
         else:
             self.url = self.parsedSettings.url
             self.url2 = self.parsedSettings.url2
 
+        if self.parsedSettings.pools or self.url2 is not None:
+            if self.url is not None:
+                self.pools.append((self.url, 1))
+            for pool in self.parsedSettings.pools:
+                self.pools.append(self._parsePool(pool))
+            if self.url2 is not None:
+                self.pools.append((self.url2, 0))
+
         for arg in args:
             self._kernelOption(arg)
 
     def getQueueSize(self):
         return max(1, self.parsedSettings.queuesize)
+    def getFetchMargin(self):
+        return max(0.0, self.parsedSettings.fetchmargin)
+    def getPrefetchDepth(self):
+        return max(1, self.parsedSettings.prefetch)
+    def getLatency(self):
+        return max(1, self.parsedSettings.latency) / 1000.0
     def getAvgSamples(self):
         return self.parsedSettings.avgsamples
+    def getCacheDir(self):
+        return self.parsedSettings.cachedir
+    def getCacheSize(self):
+        return max(0, self.parsedSettings.cachesize) * 1024 * 1024
+
+    def _parsePool(self, pool):
+        url, sep, weight = pool.rpartition('#')
+        if not sep:
+            return (pool, 1)
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = -1
+        if weight < 0:
+            print("Invalid pool weight: %s" % pool)
+            exit()
+        return (url, weight)
 
     def _kernelOption(self, arg):
         pair = arg.split('=',1)
@@ -92,15 +159,26 @@ class CommandLineOptions(object):
             self.logger = ConsoleLogger(miner, self.parsedSettings.verbose)
         return self.logger
 
-    def makeConnection(self, requester, backup = False):
-        url = self.url2 if backup else self.url
+    def makeConnection(self, requester):
+        if self.parsedSettings.benchmark:
+            return SyntheticClient(requester)
+        url = self.url
         try:
+            if len(self.pools) > 1:
+                return PoolManager(requester, self.pools)
+            elif self.pools:
+                url = self.pools[0][0]
             connection = minerutil.openURL(url, requester)
         except ValueError, e:
             print(e)
             exit()
         return connection
 
+    def makeJournal(self, requester):
+        if self.parsedSettings.journal is None:
+            return None
+        return ShareJournal(requester, self.parsedSettings.journal)
+
     def makeKernel(self, requester):
         if not self.kernel:
             module = self.parsedSettings.kernel
@@ -123,4 +201,7 @@ if __name__ == '__main__':
     miner = Miner()
     miner.start(options)
 
+    if options.parsedSettings.benchmark:
+        Benchmark(miner, options.parsedSettings.benchtime).start()
+
     reactor.run()
\ No newline at end of file